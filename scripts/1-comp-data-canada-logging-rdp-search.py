@@ -4,43 +4,27 @@
 # python=3.11
 
 ### DIRECTORIES --------------------------
-# refinivit/lseg files
-import refinitiv.data as rd
-from refinitiv.data.errors import RDError
-from refinitiv.data.content import search
-
 # data analysis and logging
 import pandas as pd
-import openpyxl as xl
-import time
-import datetime
-import string
-import pytest
-from rapidfuzz import fuzz, process
 
 # other
 import os  # working directories
-import re  # regex
-
-### SET DATA FILES WORKING DIRECTORY -----------------
-path = "/Users/ucliipp/Library/CloudStorage/OneDrive-SharedLibraries-UniversityCollegeLondon/CEP-IIPP P4NE grant 2019-2021 - Documents/General/WWF tipping points/Main research/Empirical paper/Company research"
-os.chdir(path)
 
-### BEGIN API SESSION ----------------------
-# set Refinitiv Data Platform API login key as "app_key_rd" in local env via terminal
-app_key_rd = "[define API key in local environment]"
-rd.session.desktop.Definition(app_key=app_key_rd)
-session = rd.session.desktop.Definition(app_key=app_key_rd).get_session()
-rd.open_session()
+# bulk name similarity scoring
+from name_matching import score_name_pairs
 
+# shared company name cleaning
+from name_normalisation import normalise_names
 
-# test to see if session is open
-def rd_session_test():
-    test = rd.get_data(universe="MSFT.O", fields=["TR.CommonName"])
-    return test
+# grouping near-duplicate names
+from name_clustering import cluster_names
 
+# summing overlap exports in chunks
+from overlap_aggregation import aggregate_overlap
 
-rd_session_test().notna().any().any()  # Should return a non-empty dataframe, will read "True" if passed
+### SET DATA FILES WORKING DIRECTORY -----------------
+path = "/Users/ucliipp/Library/CloudStorage/OneDrive-SharedLibraries-UniversityCollegeLondon/CEP-IIPP P4NE grant 2019-2021 - Documents/General/WWF tipping points/Main research/Empirical paper/Company research"
+os.chdir(path)
 
 ### INPUT DATA AND FIELDS ---------------
 
@@ -49,66 +33,40 @@ gfw_logging = pd.read_excel(
 )
 
 
-### EXPLORING SIMILARITY BETWEEN COMPANY NAMES ----------------
-# similarity comparison function
-def fuzzy_match(row):
-    return round(
-        fuzz.ratio(row["gfw_name_clean"], row["gfw_next_name_clean"]), 3
-    )  # returns similarity %
-
-
-# clean text function
-def clean_text(text):
-    # Convert non-string data to string
-    text = (
-        str(text).strip().lower()
-    )  # Strip leading/trailing whitespace and convert to lowercase
-
-    # Remove all special characters except spaces
-    text = re.sub(r"[^\w\s]|-", " ", text)
+### GROUPING SIMILAR COMPANY NAMES ----------------
+# every name is compared with all similar names (sharing a word or first few letters), not just the next row,
+# and names above the similarity threshold are grouped, with a proposed final_name for each group
+logging_clusters = cluster_names(gfw_logging["gfw_name"]).rename(columns={"name": "gfw_name"})
 
-    return text
+# similarity of each name to its proposed final name, to help check the groups
+logging_clusters["name_comparison"] = score_name_pairs(
+    normalise_names(logging_clusters["gfw_name"]),
+    normalise_names(logging_clusters["final_name"]),
+    scorers=["ratio"],
+)["ratio"]  # returns similarity %
 
-
-# add column that includes the entry from below
-gfw_logging["gfw_next_name"] = gfw_logging["gfw_name"].shift(-1)
-
-# clean both columns
-gfw_logging["gfw_name_clean"] = gfw_logging["gfw_name"].apply(clean_text)
-gfw_logging["gfw_next_name_clean"] = gfw_logging["gfw_next_name"].apply(clean_text)
-
-# string comparison
-gfw_logging["name_comparison"] = gfw_logging.apply(fuzzy_match, axis=1)
-gfw_logging = gfw_logging.sort_values(by="name_comparison", ascending=False)
-
-gfw_logging.to_excel(
-    "./Boreal-Canada/Output-data/canada-logging-companies-eda.xlsx", index=False
-)
-
-# import consolidated list
-logging_companies = pd.read_excel(
-    "./Boreal-Canada/Output-data/canada-logging-companies-consolidated.xlsx"
+logging_clusters.to_excel(
+    "./Boreal-Canada/Output-data/canada-logging-companies-consolidated-proposed.xlsx", index=False
 )
 
-## Importing the logging overlap data
-boreal_logging = pd.read_csv(
-    "./Boreal-Canada/Output-data/canada_logging_overlap_split.csv"
-)
-
-# joining consolidated names onto the overlap data
-boreal_logging = boreal_logging.merge(
-    logging_companies[["gfw_name", "final_name"]],
-    left_on="Company",
-    right_on="gfw_name",
-    how="left",
-)
-
-# grouping by company
-
-boreal_logging_grouped = (
-    boreal_logging.groupby("final_name", as_index=False)
-    .agg({"Boreal_overlap_area_km": "sum"})
-    .sort_values(by="Boreal_overlap_area_km", ascending=False)
+# import consolidated list, i.e. the proposed list once checked
+# until a checked list exists, the proposed one is used
+consolidated_path = "./Boreal-Canada/Output-data/canada-logging-companies-consolidated.xlsx"
+if os.path.exists(consolidated_path):
+    logging_companies = pd.read_excel(consolidated_path)
+else:
+    logging_companies = logging_clusters
+
+## Summing the logging overlap data by consolidated name
+# the overlap csv is read in chunks with only the company and area columns, so memory stays bounded as it grows
+# companies are mapped to their final name with a dictionary, and companies without one are left out
+logging_final_names_dict = dict(zip(logging_companies["gfw_name"], logging_companies["final_name"]))
+
+boreal_logging_grouped = aggregate_overlap(
+    "./Boreal-Canada/Output-data/canada_logging_overlap_split.csv",
+    logging_final_names_dict,
+    name_col="Company",
+    value_col="Boreal_overlap_area_km",
 )
 
 boreal_logging_grouped.to_excel(
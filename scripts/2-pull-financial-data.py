@@ -14,23 +14,51 @@
 # python=3.11
 
 ### DIRECTORIES --------------------------
-# refinivit/lseg files
-import refinitiv.data as rd
-from refinitiv.data.errors import RDError
-from refinitiv.data.content import search
-
 # data analysis and logging
 import pandas as pd
-import openpyxl as xl
 import time
 import datetime
-import string
-import pytest
 
 # other
 import os #working directories
 import re #regex
 
+# deals queries
+from lseg_deals import (
+    deal_date_col,
+    plan_permid_year_ranges,
+    plan_work_items,
+    query_flds,
+)
+from lseg_deals import pull_deals_work_item as pull_deals_work_item_from_source
+
+# concurrent, rate-limited requests
+from fetch_engine import TokenBucket, rate_limit, run_work_items
+
+# collecting results
+from results_sink import ResultsSink
+
+# checkpoint and resume
+from job_journal import JobJournal
+
+# company hierarchies as validity intervals
+from company_hierarchy import CompanyHierarchy
+
+# typed parquet storage
+from columnar_store import write_dataset
+
+# on-disk response cache
+from response_cache import ResponseCache
+
+# retrying failed requests
+from retry_policy import RetryPolicy
+
+# timing requests and reporting
+from run_report import RunReport
+
+# live or replayed LSEG data
+from data_source import RefinitivSource, ReplaySource, offline_workdir
+
 ### SIMPLE FUNCTIONS ------------------------
 
 def to_snake_case(str): 
@@ -43,27 +71,27 @@ path = "/Users/ucliipp/Library/CloudStorage/OneDrive-UniversityCollegeLondon/Doc
 os.chdir(path)
 
 ### BEGIN API SESSION ----------------------
-# set Refinitiv Data Platform API login key as "app_key_rd" in local env via terminal
-# this is necessary due to licence restrictions
-# Desktop Refinitiv App needs to be open to do this
-# open desktop API session
-app_key_rd = '[define API key in local environment]'
-rd.session.desktop.Definition(app_key = app_key_rd)
-session = rd.session.desktop.Definition(app_key = app_key_rd).get_session()
-rd.open_session()
-
-# test to see if session is open
-def rd_session_test():
-    test = rd.get_data(
-    universe='MSFT.O',
-    fields = ['TR.CommonName']
-    )
-    return test
-
-rd_session_test().notna().any().any() # Should return a non-empty dataframe, will read "True" if passed
+# the desktop session (Desktop Refinitiv App needs to be open) is opened on the first request and reused,
+# reconnecting if it drops. set the API login key in lseg_session.py
+
+# set offline = True to replay recorded responses instead of querying LSEG
+# responses are recorded in the response cache whenever the script runs live with use_cache = True
+# offline runs don't use the cache and read and write results in ./offline-run, never the live results,
+# so set synthetic = True to make up any responses that weren't recorded, otherwise they raise an error
+offline = False
+synthetic = False
+if offline:
+    data_source = ReplaySource(synthetic=synthetic)
+    os.chdir(offline_workdir())
+else:
+    data_source = RefinitivSource()
 
 ### INPUT DATA AND FIELDS ------------------------
-MAX_ITEMS_PER_REQUEST_FOR_GET_DATA = 7500
+# the 7,500 item limit per get_data request is set in lseg_deals.py
+
+# put many permids into one query rather than one query per permid
+# set to False to go back to querying permids one at a time
+batch_mode = True
 
 # test data for checking code working
 permids_test = ["5086635324", "4295903463"]
@@ -76,20 +104,12 @@ df_companies_permids_test = pd.DataFrame(
 # companies to pull financial data for
 df_companies = pd.read_excel("/Users/ucliipp/Library/CloudStorage/OneDrive-SharedLibraries-UniversityCollegeLondon/CEP-IIPP P4NE grant 2019-2021 - Documents/General/WWF tipping points/Main research/2025 Empirical paper/Company research/companies.xlsx", sheet_name="yearly company hierarchies")
 
-# collect all permids into one longer df
-df_companies_permids = pd.concat([df_companies.loc[:,["company","year","legal_entity_permid"]],
-                                  df_companies.loc[:,["company","year","legal_entity_ultimate_parent_permid"]]])
+# store each (company, legal entity, ultimate parent) link once, with the years it holds
+company_hierarchy = CompanyHierarchy.from_yearly(df_companies)
 
-# pivot even longer to only have one column of permids, preserving hierarchy
-df_companies_permids = pd.melt(df_companies_permids,
-                               id_vars = ['company','year'],var_name='hierarchy_level',value_name='permid')
-
-# drop nas to finalise list
-df_companies_permids = df_companies_permids.dropna(subset=['permid']).reset_index()
-
-# make sure they're strings, needed for searching in Refinitiv
-df_companies_permids['permid'] = df_companies_permids['permid'].apply(lambda x: str(int(x)) if x == x else "")
-df_companies_permids['year'] = df_companies_permids['year'].astype(str)
+# one row per (company, year, hierarchy level, permid), preserving hierarchy, without missing permids
+# permids are nullable integers, they're only turned into strings when queries are built
+df_companies_permids = company_hierarchy.permid_years()
 
 # years to pull data for 
 yrs = list(range(2014,2025))
@@ -123,119 +143,121 @@ flds_dict_fundamentals = {
 def create_variable(name, value):
     globals()[name] = value
 
-# allow for multiple retries in case server times out
+# allow for multiple retries in case server times out or throttles requests
+# retries back off exponentially with jitter, and all requests pause if the backend looks unhealthy
 retry_max = 5
-retry_count = 1
-
-# strings that define the universes for each asset class
-universes_dict_flows = {
-    "Loans": "SCREEN(U(IN(DEALS)/*UNV:DEALSLOAN*/),",
-    "Bond deals": "SCREEN(U(IN(DEALS)/*UNV:DEALSBOND*/),TR.NIisECM=False,",
-    "Equity deals": "SCREEN(U(IN(DEALS)/*UNV:DEALSEQ*/),TR.NIisECM=True,"
+run_report = RunReport("deals-pull") # latency, rows, errors, retries and cache hits for every request
+retry_policy = RetryPolicy(max_retries=retry_max, report=run_report)
+
+# number of requests in flight at once and requests per second allowed to LSEG
+max_workers = 4
+requests_per_second = 4
+
+# every call to LSEG, including retries and split batches, waits for the rate limiter
+# the wait for a token is reported separately from LSEG latency
+rate_limiter = TokenBucket(rate=requests_per_second, burst=max_workers)
+get_data_rate_limited = rate_limit(data_source.get_data, rate_limiter)
+
+# repeated queries are served from the on-disk cache without waiting for the rate limiter
+# set use_cache = False to always query LSEG
+use_cache = True
+response_cache = ResponseCache()
+if use_cache and not offline:
+    get_data_rate_limited = response_cache.wrap(get_data_rate_limited, "get_data")
+
+# time every request, summarised per asset class
+get_data_by_asset_class = {
+    asset_class: run_report.instrument(
+        get_data_rate_limited, "get_data", group=asset_class, cache=response_cache, rate_limiter=rate_limiter)
+    for asset_class in asset_classes_flows
 }
 
-participants_dict_flows = {
-    "Loans": "IN(TR.LNParticipant(LNPartRole=LNB,LNBIP,LNBUP),",
-    "Bond deals": "IN(TR.NIParticipant(NIDealPartRole=IS,ISIP,ISUP),",
-    "Equity deals": "IN(TR.NIParticipant(NIDealPartRole=IS,ISIP,ISUP),"
-}
+# query strings for each asset class are defined in lseg_deals.py
 
-deals_status_dict = {
-    "Loans": 'IN(TR.LNStatusOfLoan,"5","4","C"))',
-    "Bond deals": 'IN(TR.NITransactionStatus,"LIVE"))',
-    "Equity deals": 'IN(TR.NITransactionStatus,"LIVE"))'
-}
+# pull deals for one (asset class, year range, permid batch) work item, retrying if the server times out
+def pull_deals_work_item(work_item):
+    asset_class = work_item[0]
+    return pull_deals_work_item_from_source(
+        get_data_by_asset_class[asset_class], work_item, flds_dict_flows[asset_class], retry_policy)
+
+# record each completed work item and its results on disk so a crash only loses in-flight requests
+# resume = True skips work items completed by an interrupted run, set to False to start a fresh pull
+# the journal is cleared once every work item has completed and the datasets are saved, so later runs pull again
+# each work item's key includes its asset class's fields, so changing the fields pulls it again
+resume = True
+journal = JobJournal("./intermediate-results/deals-pull-journal", resume=resume)
+pull_deals_work_item_journaled = journal.run(
+    pull_deals_work_item, unit_params=lambda work_item: flds_dict_flows[work_item[0]])
+
+# collapse (permid, year) pairs into contiguous year ranges per permid, dropping duplicate pairs
+permid_year_ranges = plan_permid_year_ranges(df_companies_permids, yrs)
+n_permid_years = df_companies_permids.loc[df_companies_permids["year"].isin(yrs), ["permid", "year"]].drop_duplicates().shape[0]
+print(f"{n_permid_years} (permid, year) pairs collapsed into {len(permid_year_ranges)} year ranges")
 
 # pull flows data for all three asset classes
 start_exec = time.time()
+n_failed = 0  # work items that failed after all retries, pulled again on the next run
 for asset_class in asset_classes_flows:
 
-    # create empty dataframe to store data for the deals for this asset class
-    df = pd.DataFrame()
+    # collect the deals for this asset class, concatenated once at the end
+    deals_sink = ResultsSink()
 
     # separating out pulls into years to account for changes in hierarchies
+    # each permid is queried once per run of consecutive years it appears in, rather than once per year
     # can change df_companies_permids to df_companies_permids_test (small df) to troubleshoot
-    for yr in yrs:
-        permids_companies_this_yr = df_companies_permids.loc[df_companies_permids["year"]==yr, "permid"].tolist()
-        
-        # debugging: check there are permids being searched
-        print(f"Year: {yr}, PermIDs found: {len(permids_companies_this_yr)}")
-        print(f"Processing {asset_class} for year {yr} with {len(permids_companies_this_yr)} permIDs")
-
-        date_start = yr + "0101"
-        date_end = yr + "1231"
-        dates_dict_flows = {
-            "Loans": f"),BETWEEN(TR.LNTrancheClosingDate,{date_start},{date_end}),",
-            "Bond deals": f"),BETWEEN(TR.NIIssueDate,{date_start},{date_end}),",
-            "Equity deals": f"),BETWEEN(TR.NIIssueDate,{date_start},{date_end}),"
-            }
-
-    # construct refinitiv search for this asset class
-        for permid in permids_companies_this_yr:
-            retry_count = 1 # reset retry count for each permid
-            retry = True
-
-            while retry:
-                try: # set up RDP query for this asset class, permid, and year
-                    query = universes_dict_flows[asset_class] + participants_dict_flows[asset_class] + permid + dates_dict_flows[asset_class] + deals_status_dict[asset_class]
-                
-                    # debugging: check query makes sense
-                    if retry_count == 1:
-                        print(f"Sample query for {asset_class} ({yr}): {query}")
-
-                    # pull data
-                    current_df = rd.get_data(
-                        universe=[query], 
-                        fields = flds_dict_flows[asset_class])
-
-                    # Check if the dataframe is empty
-                    if current_df.empty:
-                        print(f"No data found for {asset_class} ({yr}) with permid {permid}. Continuing without joining on...")
-                    else:
-                        # Reset index and remove any duplicates to prevent errors
-                        current_df = current_df.drop_duplicates()
-
-                        # Tag results with the queried company permID, asset class for tractability
-                        current_df['queried_company_permid'] = permid
-                        current_df['asset_class'] = asset_class
-
-                        # Add results to existing df
-                        df = pd.concat([df, current_df.reset_index(drop=True)], ignore_index=True, axis=0)
-
-                    # exit loop unless an error occurred, otherwise try again
-                    retry = False
-
-                except Exception as e:
-                    print(f"An error occurred with {permid} ({yr}): {e}")
-
-                    if retry_count <= retry_max:
-                        print("Retrying...")
-                        retry_count +=1
-                        time.sleep(0.01) # Wait for 0.01 seconds before retrying
-                    else:
-                        print(f"Retry limit reached, skipping {permid} ({yr})")
-                        retry = False # exit retry loop
-                        break
-
-        # create global variable including all results for this asset class
-    
+    work_items = plan_work_items(asset_class, permid_year_ranges, len(query_flds(asset_class, flds_dict_flows[asset_class])), batch_mode=batch_mode)
+    print(f"Processing {asset_class} with {len(work_items)} queries for {permid_year_ranges['permid'].nunique()} permIDs")
+
+    # run work items in parallel, results come back in work item order so outputs are reproducible
+    results = run_work_items(pull_deals_work_item_journaled, work_items, max_workers=max_workers)
+
+    for current_df in results:
+        if current_df is not None:
+            deals_sink.append(current_df.reset_index(drop=True))
+        else:
+            n_failed += 1
+
+    df = deals_sink.to_frame()
+
+    # attribute each deal to the company hierarchies its queried permid belonged to on the issue or closing date
+    if not df.empty:
+        df = company_hierarchy.attribute(df, 'queried_company_permid', deal_date_col(df, asset_class, flds_dict_flows[asset_class]))
+
+    # create global variable including all results for this asset class
     df_asset_class_name = "df_" + to_snake_case(asset_class)
     create_variable(df_asset_class_name, df)
     print(f"Completed processing for asset class: {asset_class}")
 
 end_exec = time.time()
 print(f'This code tool {end_exec - start_exec} to run')
+response_cache.print_stats()
+run_report.write()
 
 # check files have generated
 print(df_loans)
 print(df_bond_deals)
 print(df_equity_deals)
 
-# save files
+# save files as typed parquet datasets partitioned by year, in ./intermediate-results/datasets/<asset class>
+# re-pulled years replace the stored ones, set export_csv = False to skip the dated csv copies
+export_csv = True
+deals_datasets_dict = {
+    'loan-deals': df_loans,
+    'bond-deals': df_bond_deals,
+    'equity-deals': df_equity_deals,
+}
 today = datetime.date.today()
-df_loans.to_csv(f'./intermediate-results/{today}-loan-deals.csv')
-df_bond_deals.to_csv(f'./intermediate-results/{today}-bond-deals.csv')
-df_equity_deals.to_csv(f'./intermediate-results/{today}-equity-deals.csv')
+for dataset_name, deals in deals_datasets_dict.items():
+    write_dataset(deals, dataset_name, partition_cols=['year'])
+    if export_csv:
+        deals.to_csv(f'./intermediate-results/{today}-{dataset_name}.csv')
+
+# keep the journal if any work items failed, so the next run only pulls those
+# and stop with an error, so run-pipeline.py doesn't record this stage as up to date
+if n_failed == 0:
+    journal.clear()
+else:
+    raise RuntimeError(f'{n_failed} work items failed, kept the job journal to resume from. Run again to pull them')
 
 
 
@@ -14,23 +14,55 @@
 # python=3.11 needed for Refinitiv to work
 
 ### DIRECTORIES --------------------------
-# refinivit/lseg files
-import refinitiv.data as rd
-from refinitiv.data.errors import RDError
-from refinitiv.data.content import search
-
 # data analysis and logging
 import pandas as pd
 import numpy as np
-import openpyxl as xl
 import time
 import datetime
-from rapidfuzz import fuzz, process
 
 # other
 import os  # working directories
 import re  # regex
-import glob
+
+# collecting results
+from results_sink import ResultsSink
+
+# streaming the managers column from deal files
+from deal_files import deal_files, unique_dataset_managers, unique_managers
+from columnar_store import dataset_columns, dataset_exists
+
+# finding the managers column by field position
+from flow_attribution import fld_col, managers_flds_dict
+
+# running searches concurrently within rate limits
+from fetch_engine import TokenBucket, rate_limit, run_work_items
+
+# on-disk response cache
+from response_cache import ResponseCache
+
+# retrying failed requests
+from retry_policy import RetryPolicy
+
+# timing requests and reporting
+from run_report import RunReport
+
+# live or replayed LSEG data
+from data_source import RefinitivSource, ReplaySource, offline_workdir
+
+# searching for ultimate parents
+from ultimate_parents import search_ultimate_parent, ups_result_columns
+
+# indexed ultimate parents database
+from ultimate_parents_store import UltimateParentsStore
+
+# bulk name similarity scoring
+from name_matching import score_name_pairs
+
+# shared company name cleaning
+from name_normalisation import NameNormaliser
+
+# resolving names against the ultimate parents database before searching
+from entity_resolution import EntityIndex
 
 
 ### SIMPLE FUNCTIONS ------------------------
@@ -51,159 +83,180 @@ path = "/Users/ucliipp/Library/CloudStorage/OneDrive-UniversityCollegeLondon/Doc
 os.chdir(path)
 
 ### BEGIN DESKTOP API SESSION ----------------------
-# set Refinitiv Data Platform API login key as "app_key_rd" in local env via terminal
-# this is necessary due to licence restrictions
-# Desktop Refinitiv App needs to be open to do this
-# open desktop API session
-app_key_rd = "[define API key in local environment]"
-rd.session.desktop.Definition(app_key=app_key_rd)
-session = rd.session.desktop.Definition(app_key=app_key_rd).get_session()
-rd.open_session()
+# the desktop session (Desktop Refinitiv App needs to be open) is opened on the first request and reused,
+# reconnecting if it drops. set the API login key in lseg_session.py
+
+# set offline = True to replay recorded responses instead of querying LSEG
+# responses are recorded in the response cache whenever the script runs live with use_cache = True
+# offline runs don't use the cache and read and write results in ./offline-run, never the live results,
+# so set synthetic = True to make up any responses that weren't recorded, otherwise they raise an error
+offline = False
+synthetic = False
+if offline:
+    data_source = ReplaySource(synthetic=synthetic)
+    os.chdir(offline_workdir())
+else:
+    data_source = RefinitivSource()
 
+# max items per request for get_data = 7500
 
-# test to see if session is open
-def rd_session_test():
-    test = rd.get_data(universe="MSFT.O", fields=["TR.CommonName"])
-    return test
+# number of searches in flight at once and searches per second allowed to LSEG
+max_workers = 4
+requests_per_second = 4
 
+# every search, including retries, waits for the rate limiter
+# the wait for a token is reported separately from LSEG latency
+rate_limiter = TokenBucket(rate=requests_per_second, burst=max_workers)
+discovery_search = rate_limit(data_source.search, rate_limiter)
 
-rd_session_test().notna().any().any()  # Should return a non-empty dataframe, will read "True" if passed
+# repeated searches are served from the on-disk cache without waiting for the rate limiter
+# set use_cache = False to always query LSEG
+use_cache = True
+response_cache = ResponseCache()
+if use_cache and not offline:
+    discovery_search = response_cache.wrap(discovery_search, "discovery.search")
 
-# max items per request for get_data = 7500
+# time every search, summarised per asset class
+run_report = RunReport("ultimate-parents-mapping")
 
 ### IMPORT DATA -----------------
 asset_classes_flows = ["Bond deals", "Equity deals", "Loan deals"]
 
+# every dated deal file pulled for each asset class, oldest first
 raw_flows_files_dict = {
-    asset: [
-        f
-        for f in os.listdir("./intermediate-results/")
-        if to_file_save_format(asset) in f
-    ]
-    for asset in asset_classes_flows
+    asset: deal_files(to_file_save_format(asset)) for asset in asset_classes_flows
 }
 
+# managers column in deal csvs, by the display name get_data gave it
 ultimate_parents_col_dict = {
     "Loan deals": "All Managers, inc. Int'l Co-Managers, Parent (Full Name)",
     "Bond deals": "All Managers inc Intl Co-Managers Parent",
     "Equity deals": "All Managers inc Intl Co-Managers Parent",
 }
 
-ultimate_parents_database = pd.read_excel(
-    "./intermediate-results/ultimate_parents_database.xlsx"
-)
-
-### FIND ULTIMATE PARENTS, INITIAL MATCHES -------------------
-
-start_exec = time.time()
-ups_df = pd.DataFrame()
-
-for asset_class in asset_classes_flows:
-    # load in flows data
+# managers column in the datasets saved by script 2, by position in the fields it pulled
+# (as in 5-attribute-financial-flows.py), so it doesn't depend on display names
+flds = pd.read_excel("./input-data/lseg_columns_needed.xlsx")
+flds_asset_class_dict = {"Bond deals": "Bond deals", "Equity deals": "Equity deals", "Loan deals": "Loans"}
+flds_dict_flows = {
+    asset: flds.loc[flds["Asset class"].str.contains(flds_asset_class_dict[asset], na=False), "LSEG field name"].tolist()
+    for asset in asset_classes_flows
+}
 
-    file_name = raw_flows_files_dict[asset_class][0]
-    deals_df = pd.read_csv(f"./intermediate-results/{file_name}")
+# indexed sqlite database, updated from the excel version whenever that was saved after the last update
+# (e.g. the first time this runs, or after adding manually checked matches to the excel file)
+# to add matches from another file, use ultimate_parents_store.import_excel(<path to checked file>)
+ultimate_parents_store = UltimateParentsStore()
+if ultimate_parents_store.excel_is_newer("./intermediate-results/ultimate_parents_database.xlsx"):
+    ultimate_parents_store.import_excel("./intermediate-results/ultimate_parents_database.xlsx")
 
-    ups = (
-        deals_df[ultimate_parents_col_dict[asset_class]]
-        .str.split("|")
-        .explode()
-        .unique()
-    )
+# set to True to also write the database out as excel at the end of the run
+export_ultimate_parents_excel = False
 
-    # filter out queries that have been searched before to save processing time
-    ups_to_search = [
-        i for i in ups if i not in ultimate_parents_database["search_query"].values
-    ]
-    print(f"Searching {len(ups_to_search)} new queries for ultimate parents data")
-
-    retry_max = 5
-    retry_count = 1
-    for search_query in ups_to_search:
-        retry = True
-        while retry:
-            try:
-                search_result = rd.discovery.search(
-                    view=rd.discovery.Views.ORGANISATIONS,
-                    query=search_query,
-                    top=1,  # choose best match
-                    select="CommonName, OAPermID, ParentOrganisationName, ParentCompanyOAPermID, UltimateParentOrganisationName, UltimateParentCompanyOAPermID",
-                )
-                # if no match found, create an empty row for that query with reference data (query, asset class)
-                if search_result.empty:
-                    search_result = pd.DataFrame(
-                        {"search_query": [search_query], "source": [asset_class]}
-                    )
-                # otherwise store result and add reference data (query, asset class)
-                else:
-                    search_result["search_query"] = search_query
-                    search_result["source"] = asset_class
-
-                # concatenate onto ultimate parents dataframe
-                if not ups_df.empty:
-                    ups_df = pd.concat(
-                        [ups_df, search_result], axis=0, ignore_index=True
-                    )
-                else:
-                    ups_df = search_result  # for first search result need to populate the dataframe
-
-                retry = False  # no exceptino occurred, so set retry to False to exit the loop
-
-            except Exception as e:
-                print(f"An error occurred: {e}")
-                if retry_count <= retry_max:
-                    print(f"Retrying for {search_query}...")
-                    retry_count += 1
-                    time.sleep(
-                        0.1
-                    )  # Wait 0.1 second before retrying to prevent overloading the server
-                else:
-                    print(f"Retry limit reached, no result found for {search_query}.")
-                    break
-    print(f"Completed searching for ultimate parents for asset class: {asset_class}")
-end_exec = time.time()
-print(f"This code took {end_exec - start_exec} to run.")
+# names that closely match an organisation already in the database are resolved locally, without searching
+# set resolve_locally = False to search every new name
+resolve_locally = True
+entity_index = EntityIndex(ultimate_parents_store.to_frame()) if resolve_locally else None
 
-### CHECK QUALITY OF MATCHES -------------------
-# use fuzzy matching and checking for gaps to determine which matches to put straight onto the reference data, and which to manually check
+### FIND ULTIMATE PARENTS, INITIAL MATCHES -------------------
 
-# clean names to help with checking
+# allow for multiple retries in case server times out or throttles requests
+retry_policy = RetryPolicy(max_retries=5, report=run_report)
 
+start_exec = time.time()
+ups_sink = ResultsSink()  # collects search results, concatenated once at the end
 
-def clean_text(text):
-    # Convert non-string data to string
-    text = (
-        str(text).strip().lower()
-    )  # Strip leading/trailing whitespace and convert to lowercase
+# one queue of names across all asset classes, so a manager on e.g. both bond and equity deals is searched once
+# each name keeps the asset classes it came from
+ups_sources_dict = {}
+for asset_class in asset_classes_flows:
+    # stream the managers column in chunks, keeping only the distinct names
+    # from the parquet dataset saved by script 2, or every dated deal csv for pulls saved before it
+    dataset_name = to_file_save_format(asset_class)
+    if dataset_exists(dataset_name):
+        managers_col = fld_col(
+            dataset_columns(dataset_name),
+            flds_dict_flows[asset_class],
+            managers_flds_dict[flds_asset_class_dict[asset_class]],
+        )
+        ups = unique_dataset_managers(dataset_name, managers_col)
+        print(f"Found {len(ups)} managers in the {dataset_name} dataset")
+    else:
+        ups = unique_managers(raw_flows_files_dict[asset_class], ultimate_parents_col_dict[asset_class])
+        print(
+            f"Found {len(ups)} managers in {len(raw_flows_files_dict[asset_class])} files for asset class: {asset_class}"
+        )
+    for search_query in ups:
+        ups_sources_dict.setdefault(search_query, []).append(asset_class)
+
+# filter out queries that have been searched before to save processing time
+ups_to_search = ultimate_parents_store.new_queries(list(ups_sources_dict))
+
+# resolve high confidence matches from the local index, only unknown names go to discovery.search
+if resolve_locally:
+    resolved_ups, ups_to_search = entity_index.resolve(ups_to_search)
+    print(f"Resolved {len(resolved_ups)} new queries from the entity index")
+    if len(resolved_ups) > 0:
+        ultimate_parents_store.upsert(resolved_ups)
+
+# source is the asset classes a name came from, e.g. "Bond deals|Equity deals"
+ups_sources = {search_query: "|".join(ups_sources_dict[search_query]) for search_query in ups_to_search}
+discovery_search_by_source = {
+    source: run_report.instrument(
+        discovery_search, "discovery.search", group=source, cache=response_cache, rate_limiter=rate_limiter
+    )
+    for source in set(ups_sources.values())
+}
 
-    # Remove all special characters except spaces
-    # text = re.sub(r"[^\w\s]", '', text)
-    text = re.sub(r"[^\w\s]|-", " ", text)
 
-    # Replace standalone 'ltd' and 'co' using word boundaries
-    # Ensure replacements are done in a non-overlapping manner
-    text = re.sub(r"\blimited\b\.?", "ltd", text)
-    text = re.sub(r"\bcompany\b\.?", "co", text)
-    text = re.sub(r"\bincorporated\b\.?", "inc", text)
-    text = re.sub(r"\bcorporation\b\.?", "corp", text)
+def search_work_item(search_query):
+    source = ups_sources[search_query]
+    return search_ultimate_parent(discovery_search_by_source[source], search_query, source, retry_policy)
 
-    return text
 
+print(
+    f"Searching {len(ups_to_search)} new queries for ultimate parents data "
+    f"({sum(map(len, ups_sources_dict.values()))} names across asset classes, {max_workers} at a time)"
+)
 
-# Apply the cleaning function to the 2nd and 3rd columns
-ups_df["search_query_clean"] = ups_df["search_query"].apply(clean_text)
-ups_df["CommonName_clean"] = ups_df["CommonName"].apply(clean_text)
+# results come back in queue order, failed searches return None and are skipped by the sink
+for search_result in run_work_items(search_work_item, ups_to_search, max_workers=max_workers):
+    # add to ultimate parents results
+    ups_sink.append(search_result)
 
+print("Completed searching for ultimate parents for all asset classes")
+ups_df = ups_sink.to_frame()
 
-# function to compute similarity
-def fuzzy_match(row):
-    return round(
-        fuzz.ratio(row["search_query"], row["CommonName"]), 3
-    )  # returns similarity %
+# every search column is added even if no search matched, or nothing was left to search
+# (e.g. all names already stored or resolved locally), so the checks below run on an empty frame
+for col in ups_result_columns:
+    if col not in ups_df.columns:
+        ups_df[col] = pd.Series(None, index=ups_df.index, dtype=object)
+end_exec = time.time()
+print(f"This code took {end_exec - start_exec} to run.")
+response_cache.print_stats()
+run_report.write()
 
+### CHECK QUALITY OF MATCHES -------------------
+# use fuzzy matching and checking for gaps to determine which matches to put straight onto the reference data, and which to manually check
 
-# compare two columns via fuzzy matching
-ups_df["similarity"] = ups_df.apply(fuzzy_match, axis=1)
+# clean names to help with checking, using the shared rules in name_normalisation.py
+# cleaned names are saved so names seen in previous runs aren't cleaned again
+name_normaliser = NameNormaliser("./intermediate-results/normalised_names.csv")
+ups_df["search_query_clean"] = name_normaliser.normalise_series(ups_df["search_query"])
+ups_df["CommonName_clean"] = name_normaliser.normalise_series(ups_df["CommonName"])
+name_normaliser.save()
+
+# compare the cleaned columns via fuzzy matching, scoring whole columns at once on all cores
+# similarity is the plain ratio, token scores help triage reordered or extra words in names
+# queries without a match score 0
+name_scores = score_name_pairs(
+    ups_df["search_query_clean"],
+    ups_df["CommonName_clean"],
+)
+ups_df["similarity"] = name_scores["ratio"]  # returns similarity %
+ups_df["similarity_token_sort"] = name_scores["token_sort_ratio"]
+ups_df["similarity_token_set"] = name_scores["token_set_ratio"]
 
 # check for gaps
 columns_to_check = [
@@ -250,31 +303,21 @@ ups_df["manual_check_needed"] = (
 ## split dataset and add columns that don't need checking to master database
 matched_ups = ups_df[ups_df["manual_check_needed"] == "FALSE"]
 
-ultimate_parents_database = pd.concat(
-    [
-        ultimate_parents_database,
-        matched_ups[
-            [
-                "search_query",
-                "CommonName",
-                "OAPermID",
-                "UltimateParentOrganisationName",
-                "UltimateParentCompanyOAPermID",
-            ]
-        ],
-    ],
-    axis=0,
-    ignore_index=True,
+# add new matches to the ultimate parents database in one transaction, updating any existing search queries
+ultimate_parents_store.upsert(
+    matched_ups[
+        [
+            "search_query",
+            "CommonName",
+            "OAPermID",
+            "UltimateParentOrganisationName",
+            "UltimateParentCompanyOAPermID",
+        ]
+    ]
 )
 
-# remove any duplicates
-ultimate_parents_database = ultimate_parents_database.drop_duplicates()
-
-# overwrite ultimate parents database with new data
-
-ultimate_parents_database.to_excel(
-    "./intermediate-results/ultimate_parents_database.xlsx", index=False
-)
+if export_ultimate_parents_excel:
+    ultimate_parents_store.export_excel("./intermediate-results/ultimate_parents_database.xlsx")
 
 ## send data needing manual checking to a separate file
 today = datetime.date.today()
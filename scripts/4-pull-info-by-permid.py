@@ -10,23 +10,42 @@
 # python=3.11
 
 ### DIRECTORIES --------------------------
-# refinivit/lseg files
-import refinitiv.data as rd
-from refinitiv.data.errors import RDError
-from refinitiv.data.content import search
-
 # data analysis and logging
 import pandas as pd
-import openpyxl as xl
 import time
-import datetime
-import string
-import pytest
 
 # other
 import os  # working directories
 import re  # regex
 
+# on-disk response cache
+from response_cache import ResponseCache
+
+# timing requests and reporting
+from run_report import RunReport
+
+# live or replayed LSEG data
+from data_source import RefinitivSource, ReplaySource, offline_workdir
+
+# chunked, parallel bulk requests and retries
+from fetch_engine import TokenBucket, get_data_chunked, rate_limit
+from retry_policy import RetryPolicy
+
+# indexed ultimate parents database
+from ultimate_parents_store import UltimateParentsStore
+
+# pulling only new or stale permids
+from info_refresh import load_stored, merge_refreshed, permids_to_refresh
+
+# typed parquet storage
+from columnar_store import write_dataset
+
+# permids as nullable integers
+from permids import permid_strings, to_permids
+
+# company hierarchies as validity intervals
+from company_hierarchy import CompanyHierarchy
+
 ### SIMPLE FUNCTIONS ------------------------
 def to_snake_case(str):
     snake_case_string = re.sub(r"([a-z0-9])([A-Z])", r"\1_\2", str)
@@ -40,34 +59,63 @@ path = "/Users/ucliipp/Library/CloudStorage/OneDrive-UniversityCollegeLondon/Doc
 os.chdir(path)
 
 ### BEGIN API SESSION ----------------------
-# set Refinitiv Data Platform API login key as "app_key_rd" in local env via terminal
-# this is necessary due to licence restrictions
-# Desktop Refinitiv App needs to be open to do this
-# open desktop API session
-app_key_rd = "[define API key in local environment]"
-rd.session.desktop.Definition(app_key=app_key_rd)
-session = rd.session.desktop.Definition(app_key=app_key_rd).get_session()
-rd.open_session()
+# the desktop session (Desktop Refinitiv App needs to be open) is opened on the first request and reused,
+# reconnecting if it drops. set the API login key in lseg_session.py
+
+# set offline = True to replay recorded responses instead of querying LSEG
+# responses are recorded in the response cache whenever the script runs live with use_cache = True
+# offline runs don't use the cache and read and write results in ./offline-run, never the live results,
+# so set synthetic = True to make up any responses that weren't recorded, otherwise they raise an error
+offline = False
+synthetic = False
+if offline:
+    data_source = ReplaySource(synthetic=synthetic)
+    os.chdir(offline_workdir())
+else:
+    data_source = RefinitivSource()
 
+### SEARCH FOR INFO BY PERMID ------------------
 
-# test to see if session is open
-def rd_session_test():
-    test = rd.get_data(universe="MSFT.O", fields=["TR.CommonName"])
-    return test
+# universe x fields is split into chunks under the 7,500 item limit, run in parallel and put back in permid order
+# number of requests in flight at once and requests per second allowed to LSEG, as in scripts 2 and 3
+max_workers = 4
+requests_per_second = 4
 
+# every call to LSEG, including retries, waits for the rate limiter
+# the wait for a token is reported separately from LSEG latency
+rate_limiter = TokenBucket(rate=requests_per_second, burst=max_workers)
+get_data = rate_limit(data_source.get_data, rate_limiter)
 
-rd_session_test().notna().any().any()  # Should return a non-empty dataframe, will read "True" if passed
+# repeated queries are served from the on-disk cache without waiting for the rate limiter
+# set use_cache = False to always query LSEG
+use_cache = True
+response_cache = ResponseCache()
+if use_cache and not offline:
+    get_data = response_cache.wrap(get_data, "get_data")
 
-### SEARCH FOR INFO BY PERMID ------------------
+# time every request, summarised per type of institution
+run_report = RunReport("info-by-permid")
+
+# allow for multiple retries of each chunk in case server times out or throttles requests
+retry_policy = RetryPolicy(max_retries=5, report=run_report)
+
+# incremental = True only pulls permids that are new or were pulled more than staleness_days ago,
+# and merges them into the stored tables. set incremental = False to pull everything again
+incremental = True
+staleness_days = 30
+
+# tables are stored as typed parquet datasets in ./intermediate-results/datasets
+# set export_csv = False to skip the csv copies
+export_csv = True
+info_finance_name = "financial-institutions-info-by-permid"
+info_companies_name = "companies-info-by-permid"
 
 ## import fields needed ##
 flds = pd.read_excel("./input-data/lseg_columns_needed.xlsx")
 
 ## import permids ##
 # financial institutions
-ultimate_parents_ref_data = pd.read_excel(
-    "./intermediate-results/ultimate_parents_database.xlsx"
-)
+ultimate_parents_ref_data = UltimateParentsStore(read_only=True).to_frame()
 
 permids_finance_df = pd.concat(
     [
@@ -77,22 +125,16 @@ permids_finance_df = pd.concat(
     axis=0,
 ).drop_duplicates()
 
-permids_finance_list = permids_finance_df.astype("Int64").astype(str).to_list()
+# nullable integer permids, turned into strings only for get_data
+permids_finance_list = to_permids(permids_finance_df).dropna().drop_duplicates()
 
 # companies
 companies_ref_data = pd.read_excel(
     "/Users/ucliipp/Library/CloudStorage/OneDrive-SharedLibraries-UniversityCollegeLondon/CEP-IIPP P4NE grant 2019-2021 - Documents/General/WWF tipping points/Main research/2025 Empirical paper/Company research/companies.xlsx"
 , sheet_name="yearly company hierarchies") # update path with relative path in future once companies finalised
 
-permids_companies_df = pd.concat(
-    [
-        companies_ref_data["legal_entity_permid"].rename({"legal_entity_permid":"permid"}),
-        companies_ref_data["legal_entity_ultimate_parent_permid"].rename({"legal_entity_ultimate_parent_permid":"permid"}),
-    ],
-    axis=0,
-).drop_duplicates()
-
-permids_companies_list = permids_companies_df.astype("Int64").astype(str).to_list()
+# every legal entity and ultimate parent permid in the company hierarchies
+permids_companies_list = CompanyHierarchy.from_yearly(companies_ref_data).permids()
 
 ## search with rd.get_data ##
 
@@ -100,61 +142,99 @@ permids_companies_list = permids_companies_df.astype("Int64").astype(str).to_lis
 
 flds_finance_info = flds.loc[flds["Asset class"].str.contains("Fundamentals - Finance",na=False), "LSEG field name"].tolist()
 
-info_by_permid_finance = rd.get_data(
-    universe=permids_finance_list,
-    fields=flds_finance_info,
-    parameters={"Scale": "6"},
-)
+stored_finance = load_stored(info_finance_name, "permid") if incremental else None
+permids_finance_to_pull = permids_to_refresh(permids_finance_list, stored_finance, "permid", staleness_days)
+print(f"Pulling {len(permids_finance_to_pull)} of {len(permids_finance_list)} financial institution permids")
 
-# clean column names
-info_by_permid_finance.columns = [to_snake_case(col) for col in info_by_permid_finance.columns]
+info_by_permid_finance = None
+if len(permids_finance_to_pull) > 0:
+    info_by_permid_finance = get_data_chunked(
+        run_report.instrument(
+            get_data, "get_data", group="Fundamentals - Finance", cache=response_cache, rate_limiter=rate_limiter
+        ),
+        universe=permid_strings(permids_finance_to_pull),
+        fields=flds_finance_info,
+        parameters={"Scale": "6"},
+        max_workers=max_workers,
+        retry_policy=retry_policy,
+        group="Fundamentals - Finance",
+    )
 
-## tidying up columns
-info_by_permid_finance = info_by_permid_finance.rename({"Instrument":"permid"})
+    # clean column names
+    info_by_permid_finance.columns = [to_snake_case(col) for col in info_by_permid_finance.columns]
 
-### adding flag for government owned
-ultimate_parents_ref_data_long = (
-    ultimate_parents_ref_data.melt(id_vars=["UltimateParentOrganisationName"], value_vars=["OAPermID", "UltimateParentCompanyOAPermID"],var_name="oa_permid_type",value_name="permid")
-    .drop(columns=['oa_permid_type'])
-    .drop_duplicates(subset=['permid'])
-) # i.e., the manually assigned and checked ultimate parents for each permid
+    ## tidying up columns
+    info_by_permid_finance = info_by_permid_finance.rename(columns={"instrument":"permid"})
+    info_by_permid_finance["permid"] = to_permids(info_by_permid_finance["permid"])
 
-ultimate_parents_ref_data_long.columns = [to_snake_case(col) for col in ultimate_parents_ref_data_long.columns]
+    ### adding flag for government owned
+    ultimate_parents_ref_data_long = (
+        ultimate_parents_ref_data.melt(id_vars=["UltimateParentOrganisationName"], value_vars=["OAPermID", "UltimateParentCompanyOAPermID"],var_name="oa_permid_type",value_name="permid")
+        .drop(columns=['oa_permid_type'])
+        .drop_duplicates(subset=['permid'])
+    ) # i.e., the manually assigned and checked ultimate parents for each permid
 
-info_by_permid_finance = info_by_permid_finance.merge(
-    ultimate_parents_ref_data_long, on="permid", how="left"
-)
+    ultimate_parents_ref_data_long.columns = [to_snake_case(col) for col in ultimate_parents_ref_data_long.columns]
 
-#organization_ultimate_parent is the name from info_by_permid_finance, ultimate_parent_organisation_name is the name from ultimate_parents_ref_data
+    info_by_permid_finance = info_by_permid_finance.merge(
+        ultimate_parents_ref_data_long, on="permid", how="left"
+    )
 
-# fill in missing organization_ultimate_parent names with ultimate_parent_organisation_name
-info_by_permid_finance["organization_ultimate_parent"] = info_by_permid_finance["organization_ultimate_parent"].fillna(info_by_permid_finance["ultimate_parent_organisation_name"])
+    #organization_ultimate_parent is the name from info_by_permid_finance, ultimate_parent_organisation_name is the name from ultimate_parents_ref_data
 
-# drop ultimate parent organisation name
-info_by_permid_finance = info_by_permid_finance.drop(columns=["ultimate_parent_organisation_name"])
+    # fill in missing organization_ultimate_parent names with ultimate_parent_organisation_name
+    info_by_permid_finance["organization_ultimate_parent"] = info_by_permid_finance["organization_ultimate_parent"].fillna(info_by_permid_finance["ultimate_parent_organisation_name"])
 
-government_keywords = r"\(government\)|republic of|city of|government of|province of|municipality of|state of|emirate of|canton of|kingdom of|commonwealth of|confederation of"
+    # drop ultimate parent organisation name
+    info_by_permid_finance = info_by_permid_finance.drop(columns=["ultimate_parent_organisation_name"])
 
-info_by_permid_finance["government_ultimate_parent"] = info_by_permid_finance["organization_ultimate_parent"].str.contains(government_keywords, case=False, na=False)
+    government_keywords = r"\(government\)|republic of|city of|government of|province of|municipality of|state of|emirate of|canton of|kingdom of|commonwealth of|confederation of"
 
-# Handle missing values explicitly
-info_by_permid_finance['government_ultimate_parent'] = info_by_permid_finance['government_ultimate_parent'].where(~info_by_permid_finance['organization_ultimate_parent'].isna(), other=pd.NA)
+    info_by_permid_finance["government_ultimate_parent"] = info_by_permid_finance["organization_ultimate_parent"].str.contains(government_keywords, case=False, na=False)
 
-info_by_permid_finance.to_csv(
-    f"./intermediate-results/financial_institutions_info_by_permid.csv"
+    # Handle missing values explicitly
+    info_by_permid_finance['government_ultimate_parent'] = info_by_permid_finance['government_ultimate_parent'].where(~info_by_permid_finance['organization_ultimate_parent'].isna(), other=pd.NA)
+
+# pulled rows replace stored rows for the same permids
+info_by_permid_finance = merge_refreshed(
+    stored_finance, info_by_permid_finance, "permid", permids_finance_to_pull, permids_finance_list
 )
 
+write_dataset(info_by_permid_finance, info_finance_name)
+if export_csv:
+    info_by_permid_finance.to_csv("./intermediate-results/financial_institutions_info_by_permid.csv")
+
 
 # companies
 
 flds_companies_info = flds.loc[flds["Asset class"].str.contains("Fundamentals - Companies",na=False), "LSEG field name"].tolist()
 
-info_by_permid_companies = rd.get_data(
-    universe=permids_companies_list,
-    fields=flds_finance_info,
-    parameters={"Scale": "6"},
+stored_companies = load_stored(info_companies_name, "Instrument") if incremental else None
+permids_companies_to_pull = permids_to_refresh(permids_companies_list, stored_companies, "Instrument", staleness_days)
+print(f"Pulling {len(permids_companies_to_pull)} of {len(permids_companies_list)} company permids")
+
+info_by_permid_companies = None
+if len(permids_companies_to_pull) > 0:
+    info_by_permid_companies = get_data_chunked(
+        run_report.instrument(
+            get_data, "get_data", group="Fundamentals - Companies", cache=response_cache, rate_limiter=rate_limiter
+        ),
+        universe=permid_strings(permids_companies_to_pull),
+        fields=flds_companies_info,
+        parameters={"Scale": "6"},
+        max_workers=max_workers,
+        retry_policy=retry_policy,
+        group="Fundamentals - Companies",
+    )
+    info_by_permid_companies["Instrument"] = to_permids(info_by_permid_companies["Instrument"])
+
+info_by_permid_companies = merge_refreshed(
+    stored_companies, info_by_permid_companies, "Instrument", permids_companies_to_pull, permids_companies_list
 )
 
-info_by_permid_companies.to_csv(
-    f"./intermediate-results/companies_info_by_permid.csv"
-)
\ No newline at end of file
+write_dataset(info_by_permid_companies, info_companies_name)
+if export_csv:
+    info_by_permid_companies.to_csv("./intermediate-results/companies_info_by_permid.csv")
+
+response_cache.print_stats()
+run_report.write()
@@ -0,0 +1,96 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: ATTRIBUTING PULLED DEALS TO THE FINANCIAL INSTITUTIONS (ULTIMATE PARENTS) THAT MANAGED THEM
+# github.com/lyd-m/wwf-tipping-points
+
+### PREREQUSITES -------------------------
+# deals pulled by 2-pull-financial-data.py and managers mapped by 3-ultimate-parents-mapping.py
+# no LSEG session is needed, everything is read from ./intermediate-results
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+### DIRECTORIES --------------------------
+# data analysis and logging
+import pandas as pd
+import time
+import datetime
+
+# other
+import os  # working directories
+
+# typed parquet storage
+from columnar_store import dataset_columns, dataset_exists, read_dataset, write_dataset
+
+# indexed ultimate parents database
+from ultimate_parents_store import UltimateParentsStore
+
+# splitting deal value across managers' ultimate parents
+from flow_attribution import FinancierMap, attribute_flows, fld_col, flows_columns, managers_flds_dict, value_flds_dict
+
+### SET DATA FILES WORKING DIRECTORY -----------------
+path = "/Users/ucliipp/Library/CloudStorage/OneDrive-UniversityCollegeLondon/Documents/programming/main-projects/wwf-tipping-points"
+os.chdir(path)
+
+### SETTINGS ------------------------
+# flows are stored as a typed parquet dataset in ./intermediate-results/datasets
+# set export_csv = False to skip the dated csv copy
+export_csv = True
+flows_name = "financial-flows-by-financier"
+
+## import fields needed ##
+# the same field lists script 2 pulled with, used to find the managers and value columns by position
+flds = pd.read_excel("./input-data/lseg_columns_needed.xlsx")
+asset_classes_flows = ["Bond deals", "Equity deals", "Loans"]
+flds_dict_flows = {
+    asset: flds.loc[flds["Asset class"].str.contains(asset, na=False), "LSEG field name"].tolist()
+    for asset in asset_classes_flows
+}
+deals_datasets_dict = {
+    "Bond deals": "bond-deals",
+    "Equity deals": "equity-deals",
+    "Loans": "loan-deals",
+}
+
+## import ultimate parents ##
+financier_map = FinancierMap(UltimateParentsStore(read_only=True).to_frame())
+
+### ATTRIBUTE FLOWS ------------------
+start_exec = time.time()
+flows_sink = []
+for asset_class in asset_classes_flows:
+    dataset_name = deals_datasets_dict[asset_class]
+    if not dataset_exists(dataset_name):
+        print(f"No {dataset_name} dataset found, skipping {asset_class}")
+        continue
+
+    # only the deal id, managers, value, company and year columns are read
+    columns = dataset_columns(dataset_name)
+    managers_col = fld_col(columns, flds_dict_flows[asset_class], managers_flds_dict[asset_class])
+    value_col = fld_col(columns, flds_dict_flows[asset_class], value_flds_dict[asset_class])
+    # deals saved before they were attributed to company hierarchies only have the queried permid
+    company_col = "company" if "company" in columns else "queried_company_permid"
+    deals = read_dataset(dataset_name, columns=[columns[0], managers_col, value_col, company_col, "year"])
+    print(f"Read {len(deals)} deal rows from the {dataset_name} dataset")
+
+    flows = attribute_flows(
+        deals, managers_col, value_col, financier_map, company_col=company_col, deal_id_col=columns[0]
+    )
+    flows["asset_class"] = asset_class
+    flows_sink.append(flows)
+
+# nothing to attribute if no deals dataset has been saved yet
+if not flows_sink:
+    raise FileNotFoundError("No deals datasets found, run 2-pull-financial-data.py first")
+
+df_flows = pd.concat(flows_sink, ignore_index=True).reindex(columns=flows_columns)
+df_flows = df_flows.sort_values(["company", "asset_class", "year", "value_usd_m"], ascending=[True, True, True, False])
+
+end_exec = time.time()
+print(f"This code took {end_exec - start_exec} to run")
+print(df_flows)
+
+### SAVE FLOWS ------------------
+write_dataset(df_flows, flows_name)
+if export_csv:
+    today = datetime.date.today()
+    df_flows.to_csv(f"./intermediate-results/{today}-{flows_name}.csv", index=False)
@@ -0,0 +1,211 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: BENCHMARKING THE PIPELINE STAGES OFFLINE AGAINST REPLAYED LSEG RESPONSES
+# github.com/lyd-m/wwf-tipping-points
+
+### PREREQUSITES -------------------------
+# no desktop session or network needed: responses come from data_source.ReplaySource
+# run from anywhere with: python scripts/benchmark-pipeline.py
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import contextlib
+import datetime
+import io
+import os
+import time
+
+import pandas as pd
+
+from data_source import ReplaySource
+from fetch_engine import TokenBucket, get_data_chunked, rate_limit, run_work_items
+from lseg_deals import plan_permid_year_ranges, plan_work_items, pull_deals_work_item, query_flds
+from results_sink import ResultsSink
+from retry_policy import CircuitBreaker, RetryPolicy
+from run_report import RunReport
+from ultimate_parents import search_ultimate_parent
+
+### SETTINGS ------------------------
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+benchmarks_dir = os.path.join(repo_dir, "intermediate-results", "benchmarks")
+
+n_companies = 200
+yrs = [str(year) for year in range(2014, 2025)]
+asset_class = "Bond deals"
+
+# simulated LSEG behaviour
+latency = 0.05  # seconds per request
+latency_jitter = 0.05
+throttle_error_rate = 0.01
+timeout_error_rate = 0.01
+requests_per_second = 1000  # effectively no rate limit, so concurrency is what's measured
+
+# (batch mode, max workers) combinations to benchmark for the deal pull
+deal_pull_configs = [(False, 1), (False, 8), (True, 1), (True, 8)]
+# max workers for the ultimate parent searches and the chunked info requests, as run by scripts 3 and 4
+search_workers_configs = [1, 8]
+info_workers_configs = [1, 8]
+max_items_per_request = 500  # smaller than LSEG's limit, so the synthetic universe is split into several chunks
+
+flds = pd.read_excel(os.path.join(repo_dir, "input-data", "lseg_columns_needed.xlsx"))
+flds_deals = flds.loc[flds["Asset class"].str.contains(asset_class, na=False), "LSEG field name"].tolist()
+flds_info = flds.loc[flds["Asset class"].str.contains("Fundamentals - Companies", na=False), "LSEG field name"].tolist()
+
+
+### SYNTHETIC INPUTS ------------------------
+def synthetic_companies_permids():
+    # (permid, year) pairs like the melted company hierarchies: legal entity and ultimate parent per company per year
+    # every tenth company changes ultimate parent halfway through the period
+    rows = []
+    for company in range(n_companies):
+        legal_entity = str(5000000000 + company)
+        for yr in yrs:
+            ultimate_parent = str(4295000000 + company // 2)
+            if company % 10 == 0 and yr >= "2019":
+                ultimate_parent = str(4296000000 + company)
+            rows += [(legal_entity, yr), (ultimate_parent, yr)]
+    return pd.DataFrame(rows, columns=["permid", "year"])
+
+
+def replay_source():
+    return ReplaySource(
+        recordings_dir=None,
+        synthetic=True,
+        latency=latency,
+        latency_jitter=latency_jitter,
+        throttle_error_rate=throttle_error_rate,
+        timeout_error_rate=timeout_error_rate,
+    )
+
+
+def fast_retry_policy(report):
+    # short backoff so injected errors don't dominate the timings
+    return RetryPolicy(
+        base_delay=0.01,
+        throttle_base_delay=0.05,
+        circuit_breaker=CircuitBreaker(failure_threshold=1000),
+        report=report,
+    )
+
+
+### STAGES ------------------------
+def run_stage(stage, config, func, report):
+    # time one stage with its output silenced, and summarise its requests
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        n_rows = func()
+    wall_clock = time.perf_counter() - start
+
+    _, summary = report.summary()
+    n_requests = sum(group["requests"] for group in summary)
+    latencies = [group["latency_p95"] for group in summary if group["latency_p95"] is not None]
+    return {
+        "stage": stage,
+        "config": config,
+        "wall_clock_seconds": round(wall_clock, 3),
+        "requests": n_requests,
+        "rows": n_rows,
+        "rows_per_second": round(n_rows / wall_clock, 1),
+        "requests_per_second": round(n_requests / wall_clock, 1),
+        "latency_p95": max(latencies) if latencies else None,
+        "limiter_wait_seconds": round(sum(group["total_limiter_wait"] for group in summary), 3),
+    }
+
+
+def benchmark_deal_pull(batch_mode, max_workers):
+    report = RunReport("benchmark")
+    source = replay_source()
+    rate_limiter = TokenBucket(rate=requests_per_second, burst=max_workers)
+    get_data = report.instrument(
+        rate_limit(source.get_data, rate_limiter), "get_data", group=asset_class, rate_limiter=rate_limiter
+    )
+    retry_policy = fast_retry_policy(report)
+    ranges = plan_permid_year_ranges(synthetic_companies_permids(), yrs)
+    work_items = plan_work_items(asset_class, ranges, len(query_flds(asset_class, flds_deals)), batch_mode=batch_mode)
+
+    def pull():
+        sink = ResultsSink()
+        results = run_work_items(
+            lambda work_item: pull_deals_work_item(get_data, work_item, flds_deals, retry_policy),
+            work_items,
+            max_workers=max_workers,
+        )
+        for current_df in results:
+            sink.append(current_df)
+        return len(sink.to_frame())
+
+    return run_stage(
+        "deal pull", f"batch_mode={batch_mode}, max_workers={max_workers}", pull, report
+    )
+
+
+def benchmark_ultimate_parents_mapping(manager_names, search_workers):
+    report = RunReport("benchmark")
+    source = replay_source()
+    rate_limiter = TokenBucket(rate=requests_per_second, burst=search_workers)
+    search = report.instrument(
+        rate_limit(source.search, rate_limiter), "discovery.search", group=asset_class, rate_limiter=rate_limiter
+    )
+    retry_policy = fast_retry_policy(report)
+
+    def mapping():
+        sink = ResultsSink()
+        results = run_work_items(
+            lambda search_query: search_ultimate_parent(search, search_query, asset_class, retry_policy),
+            manager_names,
+            max_workers=search_workers,
+        )
+        for search_result in results:
+            sink.append(search_result)
+        return len(sink.to_frame())
+
+    return run_stage(
+        "ultimate parents mapping", f"{len(manager_names)} names, max_workers={search_workers}", mapping, report
+    )
+
+
+def benchmark_info_by_permid(permids, info_workers):
+    report = RunReport("benchmark")
+    source = replay_source()
+    rate_limiter = TokenBucket(rate=requests_per_second, burst=info_workers)
+    get_data = report.instrument(
+        rate_limit(source.get_data, rate_limiter),
+        "get_data",
+        group="Fundamentals - Companies",
+        rate_limiter=rate_limiter,
+    )
+    retry_policy = fast_retry_policy(report)
+
+    def info():
+        info_df = get_data_chunked(
+            get_data,
+            universe=permids,
+            fields=flds_info,
+            parameters={"Scale": "6"},
+            max_items=max_items_per_request,
+            max_workers=info_workers,
+            retry_policy=retry_policy,
+            group="Fundamentals - Companies",
+        )
+        return len(info_df)
+
+    return run_stage("info by permid", f"{len(permids)} permids, max_workers={info_workers}", info, report)
+
+
+### RUN BENCHMARKS ------------------------
+results = [benchmark_deal_pull(batch_mode, max_workers) for batch_mode, max_workers in deal_pull_configs]
+
+# synthetic manager names to search for, as script 3 would find in the deals
+manager_names = [f"Synthetic manager {i}" for i in range(200)]
+results += [benchmark_ultimate_parents_mapping(manager_names, search_workers) for search_workers in search_workers_configs]
+
+permids = synthetic_companies_permids()["permid"].drop_duplicates().tolist()
+results += [benchmark_info_by_permid(permids, info_workers) for info_workers in info_workers_configs]
+
+results = pd.DataFrame(results)
+print(results.to_string(index=False))
+
+os.makedirs(benchmarks_dir, exist_ok=True)
+results_file = os.path.join(benchmarks_dir, f"{datetime.date.today()}-benchmark.csv")
+results.to_csv(results_file, index=False)
+print(f"Benchmark results saved to {results_file}")
@@ -0,0 +1,114 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: STORING INTERMEDIATE RESULTS AS TYPED, PARTITIONED PARQUET DATASETS
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+# pyarrow
+
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import fs
+
+from permids import to_permids
+
+### SETTINGS ------------------------
+DATASETS_DIR = "./intermediate-results/datasets"
+BATCH_ROWS = 100_000
+
+# datasets are read through memory maps rather than copied into memory file by file
+local_fs = fs.LocalFileSystem(use_mmap=True)
+
+
+### TYPES ------------------------
+def unique_columns(columns):
+    # repeated labels get a position suffix, e.g. a field pulled in USD and native currency that get_data
+    # returns under one display name -> "Amount", "Amount.1", so columns can still be found by position
+    seen = {}
+    labels = []
+    for col in columns:
+        n = seen.get(col, 0)
+        seen[col] = n + 1
+        labels.append(col if n == 0 else f"{col}.{n}")
+    return labels
+
+
+def to_typed(df):
+    # permid columns become nullable integers (unless they hold e.g. pipe-delimited lists) and the year an integer
+    # object columns mixing types (e.g. numbers and text from LSEG) become strings, so arrow can store them
+    df = df.copy()
+    df.columns = unique_columns(df.columns)
+    for col in df.columns:
+        values = df[col]
+        if "permid" in str(col).lower() or col == "year":
+            numbers = to_permids(values)
+            if numbers.notna().sum() == values.replace({"<NA>": None, "": None}).notna().sum():
+                df[col] = numbers
+                continue
+        if values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) not in ("string", "empty"):
+            df[col] = values.astype("string")
+    return df
+
+
+### WRITING ------------------------
+def dataset_path(name, datasets_dir=DATASETS_DIR):
+    return os.path.join(datasets_dir, name)
+
+
+def dataset_exists(name, datasets_dir=DATASETS_DIR):
+    return os.path.isdir(dataset_path(name, datasets_dir))
+
+
+def write_dataset(df, name, partition_cols=None, datasets_dir=DATASETS_DIR):
+    # one parquet file per partition (e.g. per year), partitions written again replace what was there
+    # without partition_cols the whole dataset is replaced
+    # empty frames (e.g. no deals for an asset class) have no partition columns, so nothing is written
+    path = dataset_path(name, datasets_dir)
+    if df.empty:
+        print(f"No rows to save to {path}, leaving it unchanged")
+        return
+    table = pa.Table.from_pandas(to_typed(df), preserve_index=False)
+    pq.write_to_dataset(
+        table,
+        path,
+        partition_cols=partition_cols,
+        existing_data_behavior="delete_matching",
+    )
+    print(f"Saved {len(df)} rows to {path}")
+
+
+def write_table(df, path):
+    # one typed parquet file, written to a temporary file first so a crash never leaves a partial file
+    pq.write_table(pa.Table.from_pandas(to_typed(df), preserve_index=False), path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+### READING ------------------------
+def read_table(path):
+    return pq.read_table(path, filesystem=local_fs).to_pandas()
+
+
+def open_dataset(name, datasets_dir=DATASETS_DIR):
+    return ds.dataset(dataset_path(name, datasets_dir), partitioning="hive", filesystem=local_fs)
+
+
+def dataset_columns(name, datasets_dir=DATASETS_DIR):
+    return open_dataset(name, datasets_dir).schema.names
+
+
+def read_dataset(name, columns=None, filters=None, datasets_dir=DATASETS_DIR):
+    # only the columns and partitions asked for are read, e.g. filters=[("year", ">=", 2020)]
+    dataset = open_dataset(name, datasets_dir)
+    filter_expression = pq.filters_to_expression(filters) if filters else None
+    return dataset.to_table(columns=columns, filter=filter_expression).to_pandas()
+
+
+def read_dataset_batches(name, columns=None, batch_rows=BATCH_ROWS, datasets_dir=DATASETS_DIR):
+    # yields dataframes of at most batch_rows rows, for streaming over datasets too large to load at once
+    dataset = open_dataset(name, datasets_dir)
+    for batch in dataset.to_batches(columns=columns, batch_size=batch_rows):
+        yield batch.to_pandas()
@@ -0,0 +1,149 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: STORING COMPANY HIERARCHIES AS VALIDITY INTERVALS AND ATTRIBUTING DEALS TO THEM BY DATE
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import numpy as np
+import pandas as pd
+
+from permids import to_permids
+
+### SETTINGS ------------------------
+# columns of the "yearly company hierarchies" sheet in companies.xlsx
+yearly_columns_dict = {
+    "company": "company",
+    "year": "year",
+    "legal_entity_permid": "legal_entity_permid",
+    "ultimate_parent_permid": "legal_entity_ultimate_parent_permid",
+}
+hierarchy_levels = ["legal_entity_permid", "ultimate_parent_permid"]
+
+
+### HIERARCHY ------------------------
+def changed(permids, previous_permids):
+    # missing to missing isn't a change
+    same = permids.eq(previous_permids).fillna(permids.isna() & previous_permids.isna())
+    return ~same.astype(bool)
+
+
+class CompanyHierarchy:
+    # one row per (company, legal entity, ultimate parent) link and the years it holds,
+    # e.g. company A's legal entity had ultimate parent X from 2014 to 2018, then Y from 2019
+    # valid_from is 1 January of the first year, valid_until 1 January after the last year
+    def __init__(self, intervals):
+        self.intervals = intervals.reset_index(drop=True)
+        self.links = self.permid_links()
+
+    @classmethod
+    def from_yearly(cls, yearly, columns_dict=yearly_columns_dict):
+        # collapse one row per company per year into intervals, a new interval starting when
+        # the legal entity or ultimate parent changes or a year is missing
+        yearly = pd.DataFrame(
+            {
+                "company": yearly[columns_dict["company"]].values,
+                "year": pd.to_numeric(yearly[columns_dict["year"]]).astype(int).values,
+                "legal_entity_permid": to_permids(yearly[columns_dict["legal_entity_permid"]]).values,
+                "ultimate_parent_permid": to_permids(yearly[columns_dict["ultimate_parent_permid"]]).values,
+            }
+        )
+        yearly = yearly.drop_duplicates().sort_values(["company", "year"], kind="stable").reset_index(drop=True)
+
+        previous = yearly.shift()
+        new_interval = (
+            (yearly["company"] != previous["company"])
+            | (yearly["year"] != previous["year"] + 1)
+            | changed(yearly["legal_entity_permid"], previous["legal_entity_permid"])
+            | changed(yearly["ultimate_parent_permid"], previous["ultimate_parent_permid"])
+        )
+        intervals = (
+            yearly.groupby(new_interval.cumsum().values)
+            .agg(
+                company=("company", "first"),
+                legal_entity_permid=("legal_entity_permid", "first"),
+                ultimate_parent_permid=("ultimate_parent_permid", "first"),
+                year_start=("year", "min"),
+                year_end=("year", "max"),
+            )
+            .reset_index(drop=True)
+        )
+        intervals["valid_from"] = pd.to_datetime(intervals["year_start"].astype(str) + "-01-01")
+        intervals["valid_until"] = pd.to_datetime((intervals["year_end"] + 1).astype(str) + "-01-01")
+        print(f"{len(yearly)} company years collapsed into {len(intervals)} hierarchy intervals")
+        return cls(intervals)
+
+    def permid_links(self):
+        # one row per (permid, company, interval), for either hierarchy level, for joining on
+        # slot numbers the companies sharing a permid (e.g. an ultimate parent of several companies),
+        # so each slot has at most one interval per permid at any date
+        links = self.intervals.assign(
+            company_legal_entity_permid=self.intervals["legal_entity_permid"],
+            company_ultimate_parent_permid=self.intervals["ultimate_parent_permid"],
+        ).melt(
+            id_vars=[
+                "company", "valid_from", "valid_until", "company_legal_entity_permid", "company_ultimate_parent_permid"
+            ],
+            value_vars=hierarchy_levels,
+            var_name="hierarchy_level",
+            value_name="permid",
+        )
+        links = links.dropna(subset=["permid"])
+        links["hierarchy_level"] = links["hierarchy_level"].str.replace("_permid", "")
+        links = links.drop_duplicates(subset=["permid", "company", "valid_from"])  # legal entity is its own parent
+        links["permid"] = links["permid"].astype("int64")
+        links["slot"] = links.groupby("permid")["company"].transform(lambda c: pd.factorize(c)[0])
+        return links.sort_values("valid_from", kind="stable").reset_index(drop=True)
+
+    ### PERMIDS ------------------------
+    def permids(self):
+        # every legal entity and ultimate parent permid, e.g. to pull info for
+        return pd.Series(self.links["permid"].unique(), dtype="Int64", name="permid")
+
+    def permid_years(self):
+        # (company, year, hierarchy level, permid) rows, like melting the yearly sheet
+        n_years = (self.links["valid_until"].dt.year - self.links["valid_from"].dt.year).to_numpy()
+        rows = self.links.loc[self.links.index.repeat(n_years), ["company", "hierarchy_level", "permid"]]
+        offsets = np.arange(len(rows)) - np.repeat(np.cumsum(n_years) - n_years, n_years)
+        rows["year"] = (np.repeat(self.links["valid_from"].dt.year.to_numpy(), n_years) + offsets).astype(str)
+        rows["permid"] = rows["permid"].astype("Int64")
+        return rows[["company", "year", "hierarchy_level", "permid"]].reset_index(drop=True)
+
+    ### AS-OF JOINS ------------------------
+    def attribute(self, deals, permid_col, date_col):
+        # the company hierarchy each deal belonged to on its date, found with one sorted as-of join per slot
+        # deals matching several companies (a shared ultimate parent) get a row for each
+        # deals with no matching hierarchy on their date are kept with empty company columns
+        left = pd.DataFrame(
+            {
+                "deal_row": np.arange(len(deals)),
+                "permid": to_permids(deals[permid_col]).values,
+                "date": pd.to_datetime(deals[date_col], errors="coerce").values,
+            }
+        )
+        left = left.dropna().astype({"permid": "int64"}).sort_values("date", kind="stable")
+
+        matches = []
+        for _, slot_links in self.links.groupby("slot"):
+            matched = pd.merge_asof(
+                left,
+                slot_links.drop(columns=["slot"]),
+                left_on="date",
+                right_on="valid_from",
+                by="permid",
+                direction="backward",
+            )
+            matches.append(matched[matched["date"] < matched["valid_until"]])
+        matches = pd.concat(matches, ignore_index=True).sort_values(["deal_row", "company"], kind="stable")
+        matches = matches.astype({"deal_row": "int64"})
+
+        attributed = deals.reset_index(drop=True).merge(
+            matches[
+                ["deal_row", "company", "hierarchy_level", "company_legal_entity_permid", "company_ultimate_parent_permid"]
+            ],
+            left_index=True,
+            right_on="deal_row",
+            how="left",
+        )
+        print(f"Attributed {matches['deal_row'].nunique()} of {len(deals)} deals to company hierarchies")
+        return attributed.drop(columns="deal_row").reset_index(drop=True)
@@ -0,0 +1,227 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: SWAPPING BETWEEN LIVE REFINITIV DATA AND RECORDED OR SYNTHETIC RESPONSES
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import hashlib
+import os
+import pickle
+import random
+import re
+import shutil
+import threading
+import time
+
+import pandas as pd
+
+from lseg_session import default_session_manager
+from response_cache import CACHE_DIR, cache_key
+
+# every data source has the same two calls used by the pipeline:
+# get_data(universe, fields, parameters=None) -> dataframe, like rd.get_data
+# search(query, top, select) -> dataframe, like rd.discovery.search on the organisations view
+
+
+### LIVE REFINITIV ------------------------
+class RefinitivSource:
+    # needs the desktop app open, the shared session is opened on the first request (see lseg_session.py)
+    # if a request fails the session is checked straight away, and reopened if it dropped, before the retry
+    def __init__(self, session_manager=None):
+        self.session_manager = session_manager or default_session_manager
+
+    def get_data(self, universe, fields, parameters=None):
+        rd = self.session_manager.rd()
+        try:
+            return rd.get_data(universe=universe, fields=fields, parameters=parameters)
+        except Exception:
+            self.session_manager.check()
+            raise
+
+    def search(self, query, top, select):
+        rd = self.session_manager.rd()
+        try:
+            return rd.discovery.search(
+                view=rd.discovery.Views.ORGANISATIONS, query=query, top=top, select=select
+            )
+        except Exception:
+            self.session_manager.check()
+            raise
+
+
+### REPLAY ------------------------
+class ReplayError(Exception):
+    pass
+
+
+### OFFLINE RUNS ------------------------
+OFFLINE_DIR = "./offline-run"
+
+
+def offline_workdir(offline_dir=OFFLINE_DIR):
+    # offline runs change into offline_dir, so everything they write under ./intermediate-results (datasets,
+    # csvs, the response cache, the ultimate parents database) stays apart from live results
+    # input-data is copied in so field lists can be read, run from the project folder
+    os.makedirs(os.path.join(offline_dir, "intermediate-results", "ups-manual-checking", "to-check"), exist_ok=True)
+    shutil.copytree("./input-data", os.path.join(offline_dir, "input-data"), dirs_exist_ok=True)
+    print(f"Offline run: reading and writing results in {os.path.abspath(offline_dir)}")
+    return offline_dir
+
+
+synthetic_banks = [
+    "HSBC Holdings PLC",
+    "JPMorgan Chase & Co",
+    "Bank of America Corp",
+    "Citigroup Inc",
+    "Barclays PLC",
+    "BNP Paribas SA",
+    "Mitsubishi UFJ Financial Group Inc",
+    "Deutsche Bank AG",
+    "Royal Bank of Canada",
+    "PT Bank Mandiri (Persero) Tbk",
+]
+
+
+def stable_int(*parts):
+    # same inputs -> same number, so synthetic responses are reproducible across runs
+    return int(hashlib.md5("|".join(map(str, parts)).encode()).hexdigest()[:12], 16)
+
+
+class ReplaySource:
+    # serves responses recorded in the response cache (run once live with use_cache = True to record them)
+    # anything not recorded raises ReplayError, or is made up from the query if synthetic=True (e.g. for benchmarks)
+    # latency and errors can be injected to benchmark retries, concurrency and rate limiting
+    def __init__(
+        self,
+        recordings_dir=CACHE_DIR,
+        synthetic=False,
+        latency=0.0,
+        latency_jitter=0.0,
+        throttle_error_rate=0.0,
+        timeout_error_rate=0.0,
+        deals_per_permid_year=2,
+        no_match_rate=0.1,
+        seed=0,
+    ):
+        # absolute, so recordings are still found after an offline run changes directory
+        self.recordings_dir = os.path.abspath(recordings_dir) if recordings_dir is not None else None
+        self.synthetic = synthetic
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.throttle_error_rate = throttle_error_rate
+        self.timeout_error_rate = timeout_error_rate
+        self.deals_per_permid_year = deals_per_permid_year
+        self.no_match_rate = no_match_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def simulate_request(self):
+        with self.lock:
+            delay = self.latency + self.random.uniform(0, self.latency_jitter)
+            draw = self.random.random()
+        time.sleep(delay)
+
+        if draw < self.throttle_error_rate:
+            raise ReplayError("Error code 429 | Too many requests")
+        if draw < self.throttle_error_rate + self.timeout_error_rate:
+            raise TimeoutError("Replay request timed out")
+
+    def recorded(self, endpoint, kwargs):
+        # recordings use the same keys as the response cache
+        path = os.path.join(
+            self.recordings_dir or "", cache_key(endpoint, (), kwargs) + ".pkl"
+        )
+        if self.recordings_dir is None or not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return pickle.load(f)["response"]
+
+    def get_data(self, universe, fields, parameters=None):
+        self.simulate_request()
+        response = self.recorded(
+            "get_data", {"universe": universe, "fields": fields, "parameters": parameters}
+        )
+        if response is not None:
+            return response.copy()
+        if not self.synthetic:
+            raise ReplayError(f"No recorded response for get_data({universe!r})")
+
+        if any(str(u).startswith("SCREEN(") for u in universe):
+            return self.synthetic_deals(universe[0], fields)
+        return self.synthetic_info(universe, fields)
+
+    def search(self, query, top, select):
+        self.simulate_request()
+        response = self.recorded("discovery.search", {"query": query, "top": top, "select": select})
+        if response is not None:
+            return response.copy()
+        if not self.synthetic:
+            raise ReplayError(f"No recorded response for search({query!r})")
+
+        return self.synthetic_search(query, select)
+
+    ### SYNTHETIC RESPONSES ------------------------
+    def synthetic_value(self, fld, permid, deal_no, date_start, date_end):
+        fld_lower = fld.lower()
+        if "permid" in fld_lower:
+            return int(permid)
+        if "date" in fld_lower:
+            days = (date_end - date_start).days
+            return date_start + pd.Timedelta(days=stable_int(fld, permid, deal_no) % (days + 1))
+        if "manager" in fld_lower or "bookrunner" in fld_lower:
+            n_managers = 1 + stable_int(permid, deal_no) % 4
+            first = stable_int(permid, deal_no, "managers") % len(synthetic_banks)
+            managers = [synthetic_banks[(first + i) % len(synthetic_banks)] for i in range(n_managers)]
+            if "alloc" in fld_lower or "commitment" in fld_lower:
+                return "|".join(str(50 + stable_int(m, deal_no) % 500) for m in managers)
+            return "|".join(managers)
+        if "amount" in fld_lower or "amt" in fld_lower:
+            return float(stable_int(fld, permid, deal_no) % 5000)
+        return f"{fld} {deal_no}"
+
+    def synthetic_deals(self, query, fields):
+        # deals screen: a few deals per queried permid per year in the BETWEEN() range
+        permids = re.search(r"Participant\([^)]*\),([\d,]+)\)", query).group(1).split(",")
+        date_fld, date_start, date_end = re.search(r"BETWEEN\(([^,]+),(\d{8}),(\d{8})\)", query).groups()
+        date_start = pd.Timestamp(date_start)
+        date_end = pd.Timestamp(date_end)
+        n_deals = self.deals_per_permid_year * (date_end.year - date_start.year + 1)
+
+        rows = []
+        for permid in permids:
+            for i in range(n_deals):
+                deal_no = stable_int(permid, date_start, i)
+                row = {"Instrument": f"DEAL{deal_no}"}
+                for fld in fields:
+                    row[fld] = self.synthetic_value(fld, permid, deal_no, date_start, date_end)
+                rows.append(row)
+        return pd.DataFrame(rows, columns=["Instrument"] + list(fields))
+
+    def synthetic_info(self, universe, fields):
+        # reference data: one row per instrument
+        universe = [universe] if isinstance(universe, str) else universe
+        rows = []
+        for instrument in universe:
+            row = {"Instrument": instrument}
+            for fld in fields:
+                row[fld] = f"{fld} {instrument}"
+            rows.append(row)
+        return pd.DataFrame(rows, columns=["Instrument"] + list(fields))
+
+    def synthetic_search(self, query, select):
+        # organisation search: a best match for most queries, nothing for some
+        if stable_int(query) % 1000 < self.no_match_rate * 1000:
+            return pd.DataFrame()
+
+        permid = 4295000000 + stable_int(query) % 1000000
+        parent_permid = 4295000000 + stable_int(query, "parent") % 1000
+        row = {}
+        for col in [col.strip() for col in select.split(",")]:
+            if col.endswith("PermID"):
+                row[col] = parent_permid if "Parent" in col else permid
+            elif col == "CommonName":
+                row[col] = query
+            else:
+                row[col] = f"Parent of {query}"
+        return pd.DataFrame([row])
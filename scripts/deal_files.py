@@ -0,0 +1,66 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: READING PULLED DEAL FILES IN CHUNKS, ONLY THE COLUMNS NEEDED
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import os
+import re
+
+import pandas as pd
+
+from columnar_store import dataset_columns, read_dataset_batches
+
+### SETTINGS ------------------------
+RESULTS_DIR = "./intermediate-results"
+CHUNK_ROWS = 100_000
+
+# deal files are saved by 2-pull-financial-data.py as e.g. 2024-05-01-bond-deals.csv
+deal_file_pattern = re.compile(r"^(\d{4}-\d{2}-\d{2})-(.+)\.csv$")
+
+
+### FINDING FILES ------------------------
+def deal_files(file_save_name, results_dir=RESULTS_DIR):
+    # every dated file pulled for an asset class (e.g. file_save_name "bond-deals"), oldest first
+    files = []
+    for f in os.listdir(results_dir):
+        match = deal_file_pattern.match(f)
+        if match and match.group(2) == file_save_name:
+            files.append((match.group(1), os.path.join(results_dir, f)))
+    return [path for _, path in sorted(files)]
+
+
+### READING ------------------------
+def read_deal_chunks(paths, usecols, chunksize=CHUNK_ROWS):
+    # yields dataframes of at most chunksize rows with only usecols, file by file
+    # files missing a column (e.g. pulled with an older field list) get it as empty
+    usecols = list(usecols)
+    for path in paths:
+        header = pd.read_csv(path, nrows=0).columns
+        present = [col for col in usecols if col in header]
+        for chunk in pd.read_csv(path, usecols=present, chunksize=chunksize, dtype=str):
+            yield chunk.reindex(columns=usecols)
+
+
+def collect_managers(chunks, managers_col):
+    # distinct manager names across all chunks, in the order first seen
+    # managers are pipe-delimited in LSEG deal results, only the distinct names are kept between chunks
+    managers = {}
+    for chunk in chunks:
+        names = chunk[managers_col].dropna().astype(str).str.split("|").explode()
+        for name in names[names != ""].unique():
+            managers.setdefault(name, None)
+    return list(managers)
+
+
+def unique_managers(paths, managers_col, chunksize=CHUNK_ROWS):
+    # from csv deal files
+    return collect_managers(read_deal_chunks(paths, [managers_col], chunksize), managers_col)
+
+
+def unique_dataset_managers(name, managers_col, chunksize=CHUNK_ROWS):
+    # from a parquet deals dataset (e.g. "bond-deals"), reading only the managers column
+    if managers_col not in dataset_columns(name):
+        return []
+    return collect_managers(read_dataset_batches(name, [managers_col], chunksize), managers_col)
@@ -0,0 +1,119 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: RESOLVING MANAGER NAMES AGAINST ALREADY MATCHED ORGANISATIONS BEFORE SEARCHING REFINITIV
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+from collections import Counter, defaultdict
+
+import pandas as pd
+from rapidfuzz import fuzz
+
+from name_normalisation import default_normaliser
+
+### SETTINGS ------------------------
+# legal forms dropped from the end of names to get a core name, e.g. "hsbc holdings plc" -> "hsbc holdings"
+legal_suffixes = {
+    "ag", "as", "asa", "bhd", "bv", "co", "corp", "gmbh", "inc", "kk", "llc", "llp", "lp", "ltd",
+    "nv", "oyj", "plc", "pt", "sa", "sab", "sas", "spa", "tbk", "the",
+}
+
+MATCH_THRESHOLD = 95  # token sort similarity % needed to resolve a name without searching
+MAX_CANDIDATES = 50  # candidates scored per name, those sharing the most trigrams
+MIN_SHARED_TRIGRAMS = 3
+
+resolved_columns = [
+    "search_query",
+    "CommonName",
+    "OAPermID",
+    "UltimateParentOrganisationName",
+    "UltimateParentCompanyOAPermID",
+]
+
+
+### KEYS ------------------------
+def core_name(name, normaliser=default_normaliser):
+    tokens = normaliser.normalise(name).split()
+    while len(tokens) > 1 and tokens[-1] in legal_suffixes:
+        tokens.pop()
+    return " ".join(tokens)
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+### INDEX ------------------------
+class EntityIndex:
+    # every resolved search query and common name in the ultimate parents database, keyed by core name
+    # exact core name matches resolve straight away, otherwise candidates sharing trigrams are fuzzy scored
+    def __init__(self, ups_database, normaliser=default_normaliser):
+        self.normaliser = normaliser
+        ups_database = ups_database.dropna(subset=["OAPermID"]).reset_index(drop=True)
+        self.records = ups_database.reindex(columns=resolved_columns)
+
+        self.keys = []  # (core name, record number)
+        for name_col in ["search_query", "CommonName"]:
+            for record_no, name in self.records[name_col].items():
+                if isinstance(name, str):
+                    self.keys.append((core_name(name, normaliser), record_no))
+
+        self.exact = defaultdict(set)
+        self.trigram_index = defaultdict(set)
+        for key_no, (key, record_no) in enumerate(self.keys):
+            self.exact[key].add(record_no)
+            for trigram in trigrams(key):
+                self.trigram_index[trigram].add(key_no)
+
+        print(f"Entity index built with {len(self.keys)} names for {len(self.records)} organisations")
+
+    def unique_permid(self, record_nos):
+        # a match only counts if all the records it points to are the same organisation
+        permids = self.records.loc[list(record_nos), "OAPermID"].unique()
+        return len(permids) == 1
+
+    def resolve_name(self, name):
+        # returns (record number, method, score) or None if the name can't be resolved with high confidence
+        key = core_name(name, self.normaliser)
+        if key in self.exact and self.unique_permid(self.exact[key]):
+            return min(self.exact[key]), "exact core name", 100.0
+
+        # block: only score names sharing several trigrams with this one
+        shared = Counter(
+            key_no for trigram in trigrams(key) for key_no in self.trigram_index.get(trigram, ())
+        )
+        candidates = [
+            key_no for key_no, n_shared in shared.most_common(MAX_CANDIDATES) if n_shared >= MIN_SHARED_TRIGRAMS
+        ]
+        if not candidates:
+            return None
+
+        scores = [(fuzz.token_sort_ratio(key, self.keys[key_no][0]), key_no) for key_no in candidates]
+        best_score = max(score for score, _ in scores)
+        if best_score < MATCH_THRESHOLD:
+            return None
+
+        best_records = {self.keys[key_no][1] for score, key_no in scores if score == best_score}
+        if not self.unique_permid(best_records):
+            return None
+        return min(best_records), "fuzzy core name", round(best_score, 3)
+
+    def resolve(self, names):
+        # split names into those resolved locally (as ultimate parents database rows) and those still to search
+        resolved = []
+        unresolved = []
+        for name in names:
+            match = self.resolve_name(name) if isinstance(name, str) else None
+            if match is None:
+                unresolved.append(name)
+                continue
+
+            record_no, method, score = match
+            row = self.records.loc[record_no].to_dict()
+            row.update({"search_query": name, "match_method": method, "match_score": score})
+            resolved.append(row)
+
+        resolved = pd.DataFrame(resolved, columns=resolved_columns + ["match_method", "match_score"])
+        return resolved, unresolved
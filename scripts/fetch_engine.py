@@ -0,0 +1,151 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: RUNNING REFINITIV REQUESTS CONCURRENTLY WITHIN RATE LIMITS
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from lseg_deals import MAX_ITEMS_PER_REQUEST_FOR_GET_DATA
+
+### SETTINGS ------------------------
+# keep well inside LSEG desktop throttling limits, adjust if requests get throttled
+MAX_WORKERS = 4
+REQUESTS_PER_SECOND = 4
+BURST = 4
+
+
+### RATE LIMITING ------------------------
+class TokenBucket:
+    # allows `rate` requests per second on average, with up to `burst` requests at once
+    # the time each thread last waited for a token is kept, so reports can separate it from LSEG latency
+    def __init__(self, rate=REQUESTS_PER_SECOND, burst=BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+        self.waits = threading.local()
+
+    def reset_wait(self):
+        self.waits.seconds = 0.0
+
+    def last_wait(self):
+        # seconds this thread waited in acquire() since reset_wait(), 0 if it didn't call acquire()
+        return getattr(self.waits, "seconds", 0.0)
+
+    def acquire(self):
+        # block until a token is available, then take it
+        start = time.monotonic()
+        self.take()
+        self.waits.seconds = self.last_wait() + time.monotonic() - start
+
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.last_refill) * self.rate
+                )
+                self.last_refill = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def rate_limit(func, rate_limiter):
+    # wrap an API function (e.g. rd.get_data) so every call waits for a token first
+    def rate_limited_func(*args, **kwargs):
+        rate_limiter.acquire()
+        return func(*args, **kwargs)
+
+    return rate_limited_func
+
+
+### RUNNING WORK ITEMS ------------------------
+def run_work_items(fetch, work_items, max_workers=MAX_WORKERS):
+    # fetch is called once per work item on a pool of threads
+    # results come back in the same order as work_items, however the requests finish
+    if max_workers <= 1:
+        return [fetch(work_item) for work_item in work_items]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(fetch, work_items))
+
+
+### CHUNKED BULK REQUESTS ------------------------
+def chunk_request(universe, fields, max_items=MAX_ITEMS_PER_REQUEST_FOR_GET_DATA):
+    # split fields only if there are too many for a single instrument, then split the universe so
+    # each (universe chunk, field chunk) request stays within max_items
+    field_chunk_size = min(len(fields), max_items)
+    field_chunks = [fields[i : i + field_chunk_size] for i in range(0, len(fields), field_chunk_size)]
+
+    chunks = []
+    for field_chunk_no, field_chunk in enumerate(field_chunks):
+        universe_chunk_size = max(1, max_items // len(field_chunk))
+        for i in range(0, len(universe), universe_chunk_size):
+            chunks.append((field_chunk_no, universe[i : i + universe_chunk_size], field_chunk))
+    return chunks, len(field_chunks)
+
+
+def get_data_chunked(
+    get_data,
+    universe,
+    fields,
+    parameters=None,
+    max_items=MAX_ITEMS_PER_REQUEST_FOR_GET_DATA,
+    max_workers=MAX_WORKERS,
+    retry_policy=None,
+    group="",
+):
+    # like get_data(universe, fields, parameters) for any size of universe
+    # chunks run in parallel and come back as one dataframe in the order of the input universe
+    universe = [universe] if isinstance(universe, str) else list(universe)
+    chunks, n_field_chunks = chunk_request(universe, fields, max_items)
+    print(f"Fetching {len(universe)} instruments x {len(fields)} fields in {len(chunks)} requests")
+
+    def fetch_chunk(chunk):
+        _, universe_chunk, field_chunk = chunk
+        if retry_policy is None:
+            return get_data(universe=universe_chunk, fields=field_chunk, parameters=parameters)
+        return retry_policy.run(
+            get_data,
+            universe=universe_chunk,
+            fields=field_chunk,
+            parameters=parameters,
+            description=f"{len(universe_chunk)} instruments x {len(field_chunk)} fields",
+            group=group,
+        )
+
+    results = run_work_items(fetch_chunk, chunks, max_workers=max_workers)
+
+    # one frame per field chunk, each in universe order
+    frames = []
+    for field_chunk_no in range(n_field_chunks):
+        field_chunk_results = [
+            result for chunk, result in zip(chunks, results) if chunk[0] == field_chunk_no
+        ]
+        frame = pd.concat(field_chunk_results, ignore_index=True)
+        position = frame["Instrument"].map({instrument: i for i, instrument in enumerate(universe)})
+        frame = frame.iloc[position.argsort(kind="stable")].reset_index(drop=True)
+        frames.append(frame)
+
+    if n_field_chunks == 1:
+        return frames[0]
+
+    # join field chunks on instrument, and on row number for instruments with several rows
+    for frame in frames:
+        frame["row_within_instrument"] = frame.groupby("Instrument").cumcount()
+    combined = frames[0]
+    for frame in frames[1:]:
+        combined = combined.merge(frame, on=["Instrument", "row_within_instrument"], how="outer", sort=False)
+    return combined.drop(columns="row_within_instrument")
@@ -0,0 +1,149 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: ATTRIBUTING DEAL VALUE TO THE ULTIMATE PARENTS OF EACH DEAL'S MANAGERS
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import numpy as np
+import pandas as pd
+
+from permids import MISSING_CODE, PermIDInterner, to_permids
+
+### SETTINGS ------------------------
+# returned fields holding the pipe-delimited manager parents (the names searched by 3-ultimate-parents-mapping.py)
+# and the deal value allocated across them, found by position as get_data renames fields
+managers_flds_dict = {
+    "Loans": "TR.LNManagerParentLong(Concat='|')",
+    "Bond deals": "TR.NIAllParentManagers(Concat='|')",
+    "Equity deals": "TR.NIAllParentManagers(Concat='|')",
+}
+value_flds_dict = {
+    "Loans": "TR.LNTrancheAmount(Scale=6,Curn=USD)",
+    "Bond deals": "TR.NIProceedsAmtInclOverallotSoldThisMkt(Scale=6,Curn=USD)",
+    "Equity deals": "TR.NIProceedsAmtInclOverallotSoldThisMkt(Scale=6,Curn=USD)",
+}
+
+flows_columns = [
+    "company",
+    "asset_class",
+    "year",
+    "financier_permid",
+    "financier_name",
+    "is_matched",
+    "value_usd_m",
+    "n_deals",
+]
+
+
+def fld_col(columns, flds, fld):
+    # rd.get_data returns "Instrument" followed by one column per field, in field order
+    return columns[1 + flds.index(fld)]
+
+
+### EXPLODING MANAGERS ------------------------
+def explode_managers(managers):
+    # (row, manager code) pairs for pipe-delimited manager lists, and the distinct manager names
+    # deals repeat the same lists, so each distinct list is split once and its managers repeated for every row using it
+    list_codes, lists = pd.factorize(managers)
+    split = pd.Series(lists).str.split("|").explode()
+    split = split[split.notna() & (split.str.strip() != "")].str.strip()
+    name_codes, names = pd.factorize(split)
+
+    list_starts = np.searchsorted(split.index.to_numpy(), np.arange(len(lists)))
+    list_lengths = np.bincount(split.index.to_numpy(), minlength=len(lists))
+    has_list = list_codes != -1
+    rows = np.flatnonzero(has_list)
+    lengths = list_lengths[list_codes[has_list]]
+
+    # position of each (row, manager) pair within its list, as in CompanyHierarchy.permid_years
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    entries = np.repeat(list_starts[list_codes[has_list]], lengths) + offsets
+    return np.repeat(rows, lengths), name_codes[entries], pd.Index(names)
+
+
+### FINANCIERS ------------------------
+class FinancierMap:
+    # manager name -> ultimate parent from the ultimate parents database, as dense financier codes
+    # matched names get the code of their ultimate parent's permid, so co-managers within one group share a code
+    # unmatched names get a code of their own after the permids, so their value is still reported under the raw name
+    def __init__(self, ups_database):
+        ups_database = ups_database.dropna(subset=["search_query"]).drop_duplicates(subset=["search_query"], keep="last")
+        ups_database = ups_database.dropna(subset=["UltimateParentCompanyOAPermID"])
+        self.queries = pd.Index(ups_database["search_query"])
+        self.parent_permids = to_permids(ups_database["UltimateParentCompanyOAPermID"]).to_numpy(dtype="int64")
+        self.parent_names = ups_database["UltimateParentOrganisationName"].to_numpy(dtype=object)
+        print(f"Financier map built with {len(self.queries)} matched manager names")
+
+    def codes(self, names):
+        # financier codes for distinct manager names, and a (financier code) -> permid and name table
+        record_nos = self.queries.get_indexer(names)
+        matched = record_nos != -1
+
+        interner = PermIDInterner()
+        permid_codes = interner.codes(self.parent_permids[record_nos[matched]])
+        codes = np.empty(len(names), dtype="int64")
+        codes[matched] = permid_codes
+        codes[~matched] = len(interner) + np.arange((~matched).sum())
+
+        # each ultimate parent is named by the first matched record pointing to it
+        first_record = np.zeros(len(interner), dtype="int64")
+        first_record[permid_codes[::-1]] = record_nos[matched][::-1]
+        financier_codes = np.arange(len(interner) + (~matched).sum())
+        is_matched = financier_codes < len(interner)
+        financiers = pd.DataFrame(
+            {
+                "financier_permid": interner.permids(np.where(is_matched, financier_codes, MISSING_CODE)),
+                "financier_name": np.concatenate(
+                    [self.parent_names[first_record], np.asarray(names[~matched], dtype=object)]
+                ),
+                "is_matched": is_matched,
+            }
+        )
+        return codes, financiers
+
+
+### ATTRIBUTING FLOWS ------------------------
+def attribute_flows(deals, managers_col, value_col, financier_map, company_col="company", year_col="year", deal_id_col=None):
+    # value per (company, financier, year), each deal's value split equally across its listed managers
+    # managers with the same ultimate parent on a deal are summed, so n_deals counts each deal once per financier
+    # deals listed more than once for a company (e.g. pulled through both its legal entity and ultimate parent) count once
+    deals = deals[deals[company_col].notna()]
+    if deal_id_col is not None:
+        n_deals = len(deals)
+        deals = deals.drop_duplicates(subset=[deal_id_col, company_col])
+        if len(deals) < n_deals:
+            print(f"Dropped {n_deals - len(deals)} repeated (deal, company) rows")
+
+    rows, name_codes, names = explode_managers(deals[managers_col].to_numpy(dtype=object))
+    financier_codes, financiers = financier_map.codes(names)
+
+    values = pd.to_numeric(deals[value_col], errors="coerce").to_numpy(dtype="float64", na_value=0.0)
+    n_managers = np.bincount(rows, minlength=len(deals))
+    company_codes, companies = pd.factorize(deals[company_col])
+    years = pd.to_numeric(deals[year_col], errors="coerce").to_numpy(dtype="float64", na_value=-1).astype("int64")
+
+    # one row per (deal row, financier), then summed per (company, financier, year)
+    shares = pd.DataFrame(
+        {"row": rows, "financier": financier_codes[name_codes], "value": values[rows] / n_managers[rows]}
+    )
+    shares = shares.groupby(["row", "financier"], sort=False)["value"].sum().reset_index()
+    shares["company"] = company_codes[shares["row"].to_numpy()]
+    shares["year"] = years[shares["row"].to_numpy()]
+    flows = (
+        shares.groupby(["company", "financier", "year"], sort=False)
+        .agg(value_usd_m=("value", "sum"), n_deals=("row", "size"))
+        .reset_index()
+    )
+
+    flows = flows.join(financiers, on="financier")
+    flows["company"] = companies[flows["company"].to_numpy()]
+    flows["year"] = flows["year"].astype("Int64").mask(flows["year"] == -1)
+    allocated_value = flows["value_usd_m"].sum()
+    matched_value = flows.loc[flows["is_matched"], "value_usd_m"].sum()
+    print(
+        f"Allocated {allocated_value:,.0f} USD m from {len(deals)} deal rows to {flows['financier'].nunique()} financiers "
+        f"({matched_value / allocated_value if allocated_value else 0:.1%} to matched ultimate parents), "
+        f"{(n_managers == 0).sum()} deal rows had no managers"
+    )
+    return flows.drop(columns="financier")
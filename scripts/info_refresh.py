@@ -0,0 +1,63 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: REFRESHING STORED INFO BY PERMID INCREMENTALLY, ONLY NEW OR STALE PERMIDS ARE PULLED AGAIN
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import datetime
+import pandas as pd
+
+from columnar_store import dataset_exists, read_dataset
+from permids import PermIDInterner, to_permids
+
+### SETTINGS ------------------------
+FETCHED_AT_COL = "fetched_at"  # date each row was pulled, added to the stored tables
+STALENESS_DAYS = 30  # rows pulled longer ago than this are pulled again
+
+
+### INCREMENTAL REFRESH ------------------------
+def load_stored(name, key_col):
+    # the table saved by a previous run as a parquet dataset, or None if there isn't one
+    if not dataset_exists(name):
+        return None
+    stored = read_dataset(name)
+    stored[key_col] = to_permids(stored[key_col])
+    return stored
+
+
+def permids_to_refresh(permids, stored, key_col, staleness_days=STALENESS_DAYS, today=None):
+    # permids not in the stored table, or stored more than staleness_days ago, in their original order
+    # tables saved before fetched_at was added are treated as stale
+    permids = to_permids(permids).reset_index(drop=True)
+    if stored is None or FETCHED_AT_COL not in stored.columns:
+        return permids
+
+    fetched_at = pd.to_datetime(stored[FETCHED_AT_COL], errors="coerce")
+    cutoff = pd.Timestamp(today or datetime.date.today()) - pd.Timedelta(days=staleness_days)
+    fresh = stored.loc[fetched_at >= cutoff, key_col]
+    return permids[~permids.isin(fresh)].reset_index(drop=True)
+
+
+def merge_refreshed(stored, fetched, key_col, refreshed_permids, permids):
+    # refreshed permids replace their stored rows, permids no longer needed are dropped
+    # rows come back in the order of permids, like a full pull
+    if fetched is not None:
+        fetched = fetched.assign(**{FETCHED_AT_COL: datetime.date.today().isoformat()})
+
+    if stored is None and fetched is None:
+        return pd.DataFrame(columns=[key_col, FETCHED_AT_COL])
+    if stored is None:
+        merged = fetched
+    else:
+        kept = stored[~stored[key_col].isin(to_permids(refreshed_permids))]
+        merged = pd.concat([kept, fetched], ignore_index=True)
+
+    # permids are matched on their interned codes
+    interner = PermIDInterner()
+    interner.codes(permids)
+    n_needed = len(interner)
+    position = pd.Series(interner.codes(merged[key_col]), index=merged.index)
+    position = position.where(position < n_needed, -1)  # permids no longer needed get new codes
+    merged = merged[position >= 0]
+    return merged.iloc[position[position >= 0].argsort(kind="stable")].reset_index(drop=True)
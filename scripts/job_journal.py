@@ -0,0 +1,115 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: RECORDING COMPLETED WORK ITEMS SO LONG PULLS CAN RESUME AFTER A CRASH
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import csv
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+import pandas as pd
+
+from columnar_store import read_table, write_table
+
+JOURNAL_COLUMNS = ["unit_key", "n_rows", "partition_file", "completed_at"]
+
+
+### JOB JOURNAL ------------------------
+def unit_to_key(unit, params=None):
+    # e.g. ("Bond deals", "2014", ["5086635324", "4295903463"]) -> "Bond deals|2014|5086635324,4295903463"
+    # params that change a unit's results (e.g. the fields pulled) are added as a short hash,
+    # so units completed with different params are pulled again
+    key = "|".join(
+        ",".join(part) if isinstance(part, (list, tuple)) else str(part)
+        for part in unit
+    )
+    if params is not None:
+        key += "|" + hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:12]
+    return key
+
+
+class JobJournal:
+    # journal.csv lists every completed unit of work, with its results saved as a partition file
+    # a unit only goes in the journal once its partition is fully on disk, so a crash loses only in-flight units
+    # partitions are typed parquet files, so resumed results have the same types as freshly pulled ones
+    # the journal only covers one pull: clear() it once every unit has completed, so the next run pulls again
+    def __init__(self, journal_dir, resume=True):
+        self.journal_dir = journal_dir
+        self.partitions_dir = os.path.join(journal_dir, "partitions")
+        self.journal_file = os.path.join(journal_dir, "journal.csv")
+        self.lock = threading.Lock()
+
+        # start again from scratch unless resuming
+        if not resume and os.path.exists(journal_dir):
+            shutil.rmtree(journal_dir)
+        os.makedirs(self.partitions_dir, exist_ok=True)
+
+        self.completed = {}
+        if os.path.exists(self.journal_file):
+            journal = pd.read_csv(
+                self.journal_file, dtype={"unit_key": str, "partition_file": str}
+            )
+            self.completed = {
+                row.unit_key: row.partition_file
+                for row in journal.itertuples()
+            }
+        else:
+            with open(self.journal_file, "w", newline="") as f:
+                csv.writer(f).writerow(JOURNAL_COLUMNS)
+
+        print(f"Job journal at {journal_dir}: {len(self.completed)} units already completed")
+
+    def is_complete(self, unit_key):
+        return unit_key in self.completed
+
+    def record(self, unit_key, df):
+        # empty results are recorded without a partition file
+        partition_file = ""
+        if not df.empty:
+            partition_file = hashlib.sha1(unit_key.encode()).hexdigest() + ".parquet"
+            write_table(df, os.path.join(self.partitions_dir, partition_file))
+
+        with self.lock:
+            with open(self.journal_file, "a", newline="") as f:
+                csv.writer(f).writerow(
+                    [unit_key, len(df), partition_file, datetime.datetime.now().isoformat()]
+                )
+                f.flush()
+                os.fsync(f.fileno())
+            self.completed[unit_key] = partition_file
+
+    def load(self, unit_key):
+        # results for a completed unit
+        partition_file = self.completed[unit_key]
+        if not isinstance(partition_file, str) or partition_file == "":
+            return pd.DataFrame()
+        return read_table(os.path.join(self.partitions_dir, partition_file))
+
+    def run(self, fetch, unit_params=None):
+        # wrap a work item fetch function so completed units are loaded from disk instead of re-pulled
+        # fetch should return None for units that failed, so they are retried next time
+        # unit_params(unit) gives the params that are part of each unit's key, e.g. its field list
+        def journaled_fetch(unit):
+            unit_key = unit_to_key(unit, unit_params(unit) if unit_params else None)
+            if self.is_complete(unit_key):
+                return self.load(unit_key)
+
+            df = fetch(unit)
+            if df is not None:
+                self.record(unit_key, df)
+            return df
+
+        return journaled_fetch
+
+    def clear(self):
+        # once a pull has finished and its results are saved, so the next run starts a fresh pull
+        with self.lock:
+            shutil.rmtree(self.journal_dir, ignore_errors=True)
+            self.completed = {}
+        print(f"Cleared job journal at {self.journal_dir}")
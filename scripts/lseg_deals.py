@@ -0,0 +1,300 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: BUILDING DEALS SCREEN QUERIES FOR REFINITIV AND MAPPING RESULTS BACK TO PERMIDS
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import pandas as pd
+
+from columnar_store import unique_columns
+from permids import permids_to_str, to_permids
+
+### QUERY SETTINGS ------------------------
+MAX_ITEMS_PER_REQUEST_FOR_GET_DATA = 7500
+
+# strings that define the universes for each asset class
+universes_dict_flows = {
+    "Loans": "SCREEN(U(IN(DEALS)/*UNV:DEALSLOAN*/),",
+    "Bond deals": "SCREEN(U(IN(DEALS)/*UNV:DEALSBOND*/),TR.NIisECM=False,",
+    "Equity deals": "SCREEN(U(IN(DEALS)/*UNV:DEALSEQ*/),TR.NIisECM=True,",
+}
+
+participants_dict_flows = {
+    "Loans": "IN(TR.LNParticipant(LNPartRole=LNB,LNBIP,LNBUP),",
+    "Bond deals": "IN(TR.NIParticipant(NIDealPartRole=IS,ISIP,ISUP),",
+    "Equity deals": "IN(TR.NIParticipant(NIDealPartRole=IS,ISIP,ISUP),",
+}
+
+deals_status_dict = {
+    "Loans": 'IN(TR.LNStatusOfLoan,"5","4","C"))',
+    "Bond deals": 'IN(TR.NITransactionStatus,"LIVE"))',
+    "Equity deals": 'IN(TR.NITransactionStatus,"LIVE"))',
+}
+
+# date field used to restrict each asset class to a period
+date_flds_dict_flows = {
+    "Loans": "TR.LNTrancheClosingDate",
+    "Bond deals": "TR.NIIssueDate",
+    "Equity deals": "TR.NIIssueDate",
+}
+
+# returned fields holding the permids the participant screen matches on (issuer, immediate parent, ultimate parent)
+# used to map deals from a batched query back to the permids that were queried
+participant_permid_flds_dict = {
+    "Loans": ["TR.LNIssuerPERMID", "TR.LNIssuerImmedParentPERMID", "TR.LNIssuerUltParentPERMID"],
+    "Bond deals": ["TR.NIIssuerPermID", "TR.NIIssuerImmedParentPermID", "TR.NIIssuerUltParentPermID"],
+    "Equity deals": ["TR.NIIssuerPermID", "TR.NIIssuerImmedParentPermID", "TR.NIIssuerUltParentPermID"],
+}
+
+# rough number of deals expected per permid per year, used to size batches
+EXPECTED_ROWS_PER_PERMID = 5
+
+
+### BUILDING QUERIES ------------------------
+def build_deals_query(asset_class, permids, date_start, date_end):
+    # a single permid or a list of permids can go into the participant IN() clause
+    if isinstance(permids, str):
+        permids = [permids]
+
+    query = (
+        universes_dict_flows[asset_class]
+        + participants_dict_flows[asset_class]
+        + ",".join(permids)
+        + f"),BETWEEN({date_flds_dict_flows[asset_class]},{date_start},{date_end}),"
+        + deals_status_dict[asset_class]
+    )
+    return query
+
+
+def batch_permids(
+    permids,
+    n_flds,
+    rows_per_permid=EXPECTED_ROWS_PER_PERMID,
+    max_items=MAX_ITEMS_PER_REQUEST_FOR_GET_DATA,
+):
+    # as many permids per query as keeps expected rows x fields under the item limit
+    batch_size = max(1, max_items // (n_flds * rows_per_permid))
+    return [permids[i : i + batch_size] for i in range(0, len(permids), batch_size)]
+
+
+### PLANNING QUERIES ------------------------
+def plan_permid_year_ranges(df_permids_years, yrs=None):
+    # collapse each permid's years into contiguous ranges, e.g. 2014, 2015, 2016, 2019 -> 2014-2016, 2019-2019
+    # so a permid that is in the hierarchy every year is queried once rather than once per year
+    pairs = df_permids_years[["permid", "year"]].drop_duplicates()
+    if yrs is not None:
+        pairs = pairs[pairs["year"].isin(yrs)]
+    pairs = pairs.assign(year=pairs["year"].astype(int)).sort_values(["permid", "year"])
+
+    # a new range starts when the permid changes or a year is skipped
+    new_range = (pairs["permid"] != pairs["permid"].shift()) | (
+        pairs["year"] != pairs["year"].shift() + 1
+    )
+    ranges = (
+        pairs.groupby(new_range.cumsum())
+        .agg(permid=("permid", "first"), year_start=("year", "min"), year_end=("year", "max"))
+        .astype({"year_start": str, "year_end": str})
+        .sort_values(["year_start", "year_end", "permid"])
+        .reset_index(drop=True)
+    )
+    return ranges
+
+
+def plan_work_items(asset_class, ranges, n_flds, batch_mode=True):
+    # one (asset class, year start, year end, permid batch) work item per batch of permids sharing a range
+    work_items = []
+    for (year_start, year_end), range_permids in ranges.groupby(
+        ["year_start", "year_end"], sort=True
+    ):
+        permids = permids_to_str(range_permids["permid"]).tolist()  # queries need permids as strings
+        n_yrs = int(year_end) - int(year_start) + 1
+
+        if batch_mode:
+            permid_batches = batch_permids(
+                permids, n_flds, rows_per_permid=EXPECTED_ROWS_PER_PERMID * n_yrs
+            )
+        else:
+            permid_batches = [[permid] for permid in permids]
+
+        work_items += [
+            (asset_class, year_start, year_end, permid_batch)
+            for permid_batch in permid_batches
+        ]
+    return work_items
+
+
+### MAPPING RESULTS BACK TO PERMIDS ------------------------
+def query_flds(asset_class, flds):
+    # the fields to pull: flds plus any participant permid fields it lacks, added at the end
+    # so every field in flds keeps its position
+    return flds + [fld for fld in participant_permid_flds_dict[asset_class] if fld not in flds]
+
+
+def attribute_deals_to_permids(deals_df, permids, asset_class, flds):
+    # rd.get_data returns "Instrument" followed by one column per field, in field order
+    # flds are the fields pulled, i.e. query_flds(asset_class, ...)
+    permid_cols = [
+        deals_df.columns[1 + flds.index(fld)]
+        for fld in participant_permid_flds_dict[asset_class]
+        if fld in flds
+    ]
+    permids_set = set(to_permids(permids).dropna())
+
+    # one row per (deal row, queried permid) pair, so deals shared by several queried permids are kept for each
+    matches = []
+    for col in permid_cols:
+        col_permids = to_permids(deals_df[col])  # permids can come back as ints, floats or strings
+        matched = col_permids[col_permids.isin(permids_set)]
+        matches.append(
+            pd.DataFrame({"row": matched.index, "queried_company_permid": matched.values})
+        )
+    matches = (
+        pd.concat(matches, ignore_index=True)
+        .drop_duplicates()
+        .sort_values("row", kind="stable")
+    )
+
+    attributed_df = deals_df.loc[matches["row"]].reset_index(drop=True)
+    attributed_df["queried_company_permid"] = matches["queried_company_permid"].values
+
+    # rows matched through a permid that wasn't returned, e.g. issuer immediate parent
+    unmatched_df = deals_df.loc[~deals_df.index.isin(matches["row"])]
+
+    return attributed_df, unmatched_df
+
+
+def deal_date_col(deals_df, asset_class, flds):
+    # the issue or closing date column, found by position as get_data renames fields
+    return deals_df.columns[1 + flds.index(date_flds_dict_flows[asset_class])]
+
+
+def add_deal_year(deals_df, asset_class, flds):
+    # split deals from a multi-year query back into years using the issue or closing date
+    date_col = deal_date_col(deals_df, asset_class, flds)
+    deals_df["year"] = (
+        pd.to_datetime(deals_df[date_col], errors="coerce").dt.year.astype("Int64").astype(str)
+    )
+    return deals_df
+
+
+### PULLING DEALS ------------------------
+def get_deals(
+    get_data,
+    asset_class,
+    permids,
+    date_start,
+    date_end,
+    flds,
+    max_items=MAX_ITEMS_PER_REQUEST_FOR_GET_DATA,
+):
+    # get_data is rd.get_data, passed in so this can run with any session
+    query = build_deals_query(asset_class, permids, date_start, date_end)
+    pulled_flds = query_flds(asset_class, flds)
+    current_df = get_data(universe=[query], fields=pulled_flds)
+
+    if current_df.empty:
+        return current_df
+
+    # the item limit applies to the rows returned, before duplicates are dropped
+    truncated = current_df.shape[0] * len(pulled_flds) >= max_items
+    current_df = current_df.drop_duplicates().reset_index(drop=True)
+
+    # single permid: every deal belongs to it
+    if len(permids) == 1:
+        # a truncated multi-year query is split into two year ranges, down to single years
+        year_start, year_end = int(date_start[:4]), int(date_end[:4])
+        if truncated and year_start < year_end:
+            mid = (year_start + year_end) // 2
+            print(
+                f"Splitting {year_start}-{year_end} for permid {permids[0]} in {asset_class} (possible truncation)"
+            )
+            halves = [
+                get_deals(get_data, asset_class, permids, date_start, f"{mid}1231", flds, max_items),
+                get_deals(get_data, asset_class, permids, f"{mid + 1}0101", date_end, flds, max_items),
+            ]
+            return pd.concat(halves, ignore_index=True)
+        if truncated:
+            print(
+                f"WARNING: {asset_class} for permid {permids[0]} in {year_start} may be truncated "
+                f"at {max_items} items ({current_df.shape[0]} deals returned)"
+            )
+        current_df["queried_company_permid"] = to_permids([permids[0]] * len(current_df)).values
+        return current_df
+
+    # fields missing from the response (e.g. a field LSEG doesn't recognise) shift the columns, so deals can't be
+    # mapped back by position, and deals matched through a missing permid field (e.g. a deal of issuer A matched
+    # to its immediate parent B, both in the batch) would only be kept for A
+    fields_missing = current_df.shape[1] != 1 + len(pulled_flds)
+    unmatched_df = pd.DataFrame()
+    if not fields_missing:
+        attributed_df, unmatched_df = attribute_deals_to_permids(
+            current_df, permids, asset_class, pulled_flds
+        )
+
+    # split the batch in half if the result may have been truncated at the item limit,
+    # if some deals can't be mapped back to a queried permid from the returned fields,
+    # or if fields are missing from the response
+    if truncated or not unmatched_df.empty or fields_missing:
+        if truncated:
+            reason = "possible truncation"
+        elif fields_missing:
+            reason = f"{current_df.shape[1] - 1} of {len(pulled_flds)} fields returned"
+        else:
+            reason = f"{len(unmatched_df)} unmatched deals"
+        print(f"Splitting batch of {len(permids)} permids for {asset_class} ({reason})")
+        mid = len(permids) // 2
+        halves = [
+            get_deals(get_data, asset_class, half, date_start, date_end, flds, max_items)
+            for half in (permids[:mid], permids[mid:])
+        ]
+        return pd.concat(halves, ignore_index=True)
+
+    return attributed_df
+
+
+def pull_deals_work_item(get_data, work_item, flds, retry_policy):
+    # pull deals for one (asset class, year start, year end, permid batch) work item, retrying if the server times out
+    # returns None if the retry limit is reached, so the work item can be retried later
+    asset_class, year_start, year_end, permid_batch = work_item
+    yr = year_start if year_start == year_end else f"{year_start}-{year_end}"
+    date_start = year_start + "0101"
+    date_end = year_end + "1231"
+
+    # debugging: check query makes sense
+    query = build_deals_query(asset_class, permid_batch, date_start, date_end)
+    print(f"Sample query for {asset_class} ({yr}): {query}")
+
+    try:  # pull data, tagged with the queried company permID for each deal
+        current_df = retry_policy.run(
+            get_deals,
+            get_data,
+            asset_class,
+            permid_batch,
+            date_start,
+            date_end,
+            flds,
+            description=f"{permid_batch} ({yr})",
+            group=asset_class,
+        )
+    except Exception:
+        print(f"Retry limit reached, skipping {permid_batch} ({yr})")
+        return None
+
+    # Check if the dataframe is empty
+    if current_df.empty:
+        print(
+            f"No data found for {asset_class} ({yr}) with permids {permid_batch}. Continuing without joining on..."
+        )
+    else:
+        # repeated display names (e.g. an amount in USD and native currency) are made unique by position,
+        # as they are when journaled results are stored, so fresh and resumed results line up
+        current_df.columns = unique_columns(current_df.columns)
+
+        # Tag results with asset class for tractability
+        current_df["asset_class"] = asset_class
+
+        # split deals back into years using the issue or closing date
+        current_df = add_deal_year(current_df, asset_class, flds)
+
+    return current_df
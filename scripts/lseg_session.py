@@ -0,0 +1,78 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: ONE LAZILY OPENED, HEALTH-CHECKED REFINITIV DESKTOP SESSION PER PROCESS
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+# refinitiv.data is only imported when a session is first needed, so offline stages never load it
+
+import threading
+import time
+
+### SETTINGS ------------------------
+# set Refinitiv Data Platform API login key as "app_key_rd" in local env via terminal
+# this is necessary due to licence restrictions
+APP_KEY = "[define API key in local environment]"
+HEALTH_CHECK_INTERVAL = 30  # seconds between checks that the session is still open
+
+
+### SESSION MANAGER ------------------------
+class SessionManager:
+    # opens the desktop session on first use and reuses it for every request in the process
+    # the session's open state is checked (no data query) at most every health_check_interval seconds,
+    # and the session is reopened if it has dropped, e.g. when the desktop app restarts
+    def __init__(self, app_key=APP_KEY, health_check_interval=HEALTH_CHECK_INTERVAL):
+        self.app_key = app_key
+        self.health_check_interval = health_check_interval
+        self.session = None
+        self.last_check = 0.0
+        self.n_reconnects = 0
+        self.lock = threading.Lock()
+
+    def rd(self):
+        # the refinitiv.data module, with an open session
+        import refinitiv.data as rd
+
+        with self.lock:
+            if self.session is None:
+                self.open(rd)
+            elif time.monotonic() - self.last_check > self.health_check_interval:
+                if not self.is_open(rd):
+                    print("Refinitiv session dropped, reconnecting")
+                    self.reconnect(rd)
+                self.last_check = time.monotonic()
+        return rd
+
+    def open(self, rd):
+        self.session = rd.session.desktop.Definition(app_key=self.app_key).get_session()
+        rd.session.set_default(self.session)
+        self.session.open()
+        self.last_check = time.monotonic()
+        print(f"Opened Refinitiv desktop session ({self.session.open_state})")
+
+    def is_open(self, rd):
+        return self.session is not None and self.session.open_state == rd.OpenState.Opened
+
+    def reconnect(self, rd):
+        try:
+            self.session.close()
+        except Exception:
+            pass  # the session may already be gone
+        self.n_reconnects += 1
+        self.open(rd)
+
+    def check(self):
+        # force a health check now, e.g. after a request failed
+        with self.lock:
+            self.last_check = 0.0
+        return self.rd()
+
+    def close(self):
+        with self.lock:
+            if self.session is not None:
+                self.session.close()
+                self.session = None
+
+
+# shared across stages run in the same process, e.g. by run-pipeline.py
+default_session_manager = SessionManager()
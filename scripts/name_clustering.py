@@ -0,0 +1,105 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: GROUPING NEAR-DUPLICATE COMPANY NAMES (E.G. CONCESSION HOLDERS) INTO ONE PROPOSED FINAL NAME
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from entity_resolution import core_name
+from name_matching import score_name_pairs
+from name_normalisation import default_normaliser
+
+### SETTINGS ------------------------
+CLUSTER_THRESHOLD = 90  # names at least this similar (token sort %) are grouped together
+MAX_BLOCK_SIZE = 500  # blocks on very common words (e.g. "forest") are skipped, other words still link those names
+PREFIX_LENGTH = 4  # names sharing their first few characters are also compared
+
+
+### UNION-FIND ------------------------
+class UnionFind:
+    # groups items 0..n-1, joining the groups of each pair passed to union
+    def __init__(self, n):
+        self.parent = np.arange(n)
+
+    def find(self, i):
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:  # point everything on the path straight at the root
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def union(self, i, j):
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i != root_j:
+            self.parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    def groups(self):
+        return np.array([self.find(i) for i in range(len(self.parent))])
+
+
+### CLUSTERING ------------------------
+def blocks(keys):
+    # names (by position) sharing a word or a prefix, only these are compared with each other
+    blocks_dict = defaultdict(list)
+    for i, key in enumerate(keys):
+        for token in set(key.split()):
+            blocks_dict[("word", token)].append(i)
+        blocks_dict[("prefix", key[:PREFIX_LENGTH])].append(i)
+    return [members for members in blocks_dict.values() if 1 < len(members) <= MAX_BLOCK_SIZE]
+
+
+def cluster_names(names, threshold=CLUSTER_THRESHOLD, normaliser=default_normaliser):
+    # one row per distinct name: its cleaned core name, cluster number and proposed final name
+    # the final name of a cluster is its most frequent name in names, then its shortest
+    names = pd.Series(names).dropna()
+    counts = names.value_counts(sort=False)
+    distinct = counts.index.to_series().reset_index(drop=True)
+    keys = [core_name(name, normaliser) for name in distinct]
+
+    # names with the same core name are one cluster before any scoring
+    union_find = UnionFind(len(keys))
+    first_with_key = {}
+    for i, key in enumerate(keys):
+        union_find.union(i, first_with_key.setdefault(key, i))
+
+    # candidate pairs are the pairs within each block, each scored once, all in one call across cores
+    unique_keys = list(first_with_key)
+    unique_positions = np.array(list(first_with_key.values()))
+    pairs = [np.array(members)[np.array(np.triu_indices(len(members), k=1))] for members in blocks(unique_keys)]
+    pairs = np.unique(np.concatenate(pairs, axis=1), axis=1) if pairs else np.empty((2, 0), dtype=int)
+    keys_array = np.array(unique_keys, dtype=object)
+    scores = score_name_pairs(keys_array[pairs[0]], keys_array[pairs[1]], scorers=["token_sort_ratio"])
+    matched = scores["token_sort_ratio"].to_numpy() >= threshold
+    for i, j in zip(unique_positions[pairs[0][matched]], unique_positions[pairs[1][matched]]):
+        union_find.union(i, j)
+    n_compared = pairs.shape[1]
+
+    clusters = pd.DataFrame(
+        {
+            "name": distinct,
+            "name_clean": keys,
+            "n_rows": counts.values,
+            "cluster": union_find.groups(),
+            "name_length": distinct.str.len().values,
+        }
+    )
+    final_names = (
+        clusters.sort_values(["cluster", "n_rows", "name_length"], ascending=[True, False, True])
+        .drop_duplicates("cluster")
+        .set_index("cluster")["name"]
+    )
+    clusters["final_name"] = clusters["cluster"].map(final_names)
+    clusters["cluster_size"] = clusters.groupby("cluster")["name"].transform("size")
+    clusters["cluster"] = pd.factorize(clusters["cluster"])[0]  # number clusters 0, 1, 2, ...
+
+    print(
+        f"Grouped {len(clusters)} names into {clusters['cluster'].nunique()} clusters "
+        f"({n_compared} comparisons instead of {len(unique_keys) * (len(unique_keys) - 1) // 2})"
+    )
+    return clusters.drop(columns="name_length").sort_values(["cluster", "name"]).reset_index(drop=True)
@@ -0,0 +1,45 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: SCORING THE SIMILARITY OF COMPANY NAMES IN BULK
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import pandas as pd
+from rapidfuzz import fuzz, process
+
+### SETTINGS ------------------------
+# scorers to run over each pair of names, all return a similarity % (0-100)
+scorers_dict = {
+    "ratio": fuzz.ratio,
+    "token_sort_ratio": fuzz.token_sort_ratio,
+    "token_set_ratio": fuzz.token_set_ratio,
+}
+
+WORKERS = -1  # use all cores
+
+
+### SCORING ------------------------
+def to_names(col):
+    # missing names become None, which rapidfuzz scores as 0 similarity
+    col = pd.Series(col, dtype=object)
+    return col.where(col.notna(), None).tolist()
+
+
+def score_name_pairs(left, right, scorers=None, workers=WORKERS):
+    # similarity of each left name to the right name in the same position, for several scorers at once
+    # returns a dataframe with one column per scorer, in the same order (and index) as left
+    scorers = scorers or list(scorers_dict)
+    left_names = to_names(left)
+    right_names = to_names(right)
+
+    scores = pd.DataFrame(
+        {
+            scorer: process.cpdist(
+                left_names, right_names, scorer=scorers_dict[scorer], workers=workers
+            )
+            for scorer in scorers
+        },
+        index=left.index if isinstance(left, pd.Series) else None,
+    )
+    return scores.astype("float64").round(3)
@@ -0,0 +1,101 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: CLEANING COMPANY NAMES THE SAME WAY IN EVERY SCRIPT
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import hashlib
+import os
+import re
+
+import pandas as pd
+
+### RULES ------------------------
+# legal forms shortened to their usual abbreviation, so e.g. "X Limited" and "X Ltd" clean to the same name
+legal_forms_dict = {
+    "limited": "ltd",
+    "company": "co",
+    "incorporated": "inc",
+    "corporation": "corp",
+}
+
+# one pattern applied in a single pass: any special character (incl. hyphens) or a whole-word legal form
+name_pattern = re.compile(
+    r"[^\w\s]|\b(" + "|".join(legal_forms_dict) + r")\b"
+)
+whitespace_pattern = re.compile(r"\s+")
+
+# changes whenever the rules change, so persisted names cleaned under old rules are ignored
+RULES_VERSION = hashlib.md5(
+    (name_pattern.pattern + str(sorted(legal_forms_dict.items()))).encode()
+).hexdigest()[:8]
+
+NAMES_CACHE_PATH = "./intermediate-results/normalised_names.csv"
+
+
+def replace_match(match):
+    # legal forms -> abbreviation, special characters -> space
+    return legal_forms_dict[match.group(1)] if match.group(1) else " "
+
+
+def normalise_name(text):
+    # Strip leading/trailing whitespace and convert to lowercase
+    text = str(text).strip().lower()
+
+    # Remove all special characters except spaces, and shorten legal forms, in one pass
+    text = name_pattern.sub(replace_match, text)
+
+    # collapse the spaces left behind
+    return whitespace_pattern.sub(" ", text).strip()
+
+
+### NORMALISER ------------------------
+class NameNormaliser:
+    # remembers every name it has cleaned, so repeated names (e.g. exploded deal managers) are only cleaned once
+    # with a path, the raw and normalised names are saved there and reloaded next run
+    def __init__(self, path=None):
+        self.path = path
+        self.memo = {}
+
+        if path is not None and os.path.exists(path):
+            saved = pd.read_csv(path, dtype=str, keep_default_na=False)
+            saved = saved[saved["rules_version"] == RULES_VERSION]
+            self.memo = dict(zip(saved["raw_name"], saved["normalised_name"]))
+        self.n_saved = len(self.memo)
+
+    def normalise(self, text):
+        if text not in self.memo:
+            self.memo[text] = normalise_name(text)
+        return self.memo[text]
+
+    def normalise_series(self, names):
+        # clean each distinct name once and map back onto the whole column, missing names stay missing
+        names = pd.Series(names)
+        codes, uniques = pd.factorize(names)
+        normalised_uniques = pd.Series([self.normalise(name) for name in uniques], dtype=object)
+        normalised = normalised_uniques.reindex(codes)  # code -1 (missing) -> NaN
+        return pd.Series(normalised.values, index=names.index, name=names.name)
+
+    def save(self):
+        # only written when new names have been cleaned since loading
+        if self.path is None or len(self.memo) == self.n_saved:
+            return
+
+        pd.DataFrame(
+            {
+                "raw_name": list(self.memo),
+                "normalised_name": list(self.memo.values()),
+                "rules_version": RULES_VERSION,
+            }
+        ).to_csv(self.path, index=False)
+        self.n_saved = len(self.memo)
+        print(f"Saved {len(self.memo)} normalised names to {self.path}")
+
+
+# shared normaliser for one-off use, e.g. normalise_names(df["name"])
+default_normaliser = NameNormaliser()
+
+
+def normalise_names(names):
+    return default_normaliser.normalise_series(names)
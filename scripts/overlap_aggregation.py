@@ -0,0 +1,61 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: SUMMING LARGE CONCESSION OVERLAP EXPORTS BY COMPANY IN CHUNKS
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import numpy as np
+import pandas as pd
+
+### SETTINGS ------------------------
+CHUNK_ROWS = 500_000
+
+
+### AGGREGATING ------------------------
+def sum_chunk(chunk, name_col, value_col, name_map):
+    # sums for one chunk, by mapped name
+    # names are categorical, so each distinct name is mapped once and rows are summed by category code
+    names = chunk[name_col]
+    codes = names.cat.codes.to_numpy()
+    values = chunk[value_col].to_numpy(dtype="float64", na_value=0.0)
+
+    has_name = codes >= 0
+    sums = np.bincount(codes[has_name], weights=values[has_name], minlength=len(names.cat.categories))
+    mapped_names = names.cat.categories.map(name_map)  # names not in name_map -> NaN
+    return pd.Series(sums, index=mapped_names).groupby(level=0).sum()  # drops unmapped names
+
+
+def aggregate_overlap(
+    path,
+    name_map,
+    name_col="Company",
+    value_col="Boreal_overlap_area_km",
+    final_name_col="final_name",
+    chunksize=CHUNK_ROWS,
+):
+    # sum value_col by final name (name_map[name]) over an overlap csv too large to load at once
+    # only the two columns needed are read, and only the running sums are kept between chunks
+    # rows with names missing from name_map are left out, like a left join followed by a groupby
+    totals = pd.Series(dtype="float64")
+    n_rows = 0
+    n_unmapped = 0
+    known_names = list(name_map)
+    for chunk in pd.read_csv(
+        path,
+        usecols=[name_col, value_col],
+        dtype={name_col: "category", value_col: "float64"},
+        chunksize=chunksize,
+    ):
+        n_rows += len(chunk)
+        n_unmapped += (~chunk[name_col].isin(known_names)).sum()
+        totals = totals.add(sum_chunk(chunk, name_col, value_col, name_map), fill_value=0)
+
+    print(f"Summed {n_rows} rows of {path}, {n_unmapped} rows had no final name")
+    return (
+        totals.rename_axis(final_name_col)
+        .rename(value_col)
+        .reset_index()
+        .sort_values(by=value_col, ascending=False)
+        .reset_index(drop=True)
+    )
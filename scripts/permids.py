@@ -0,0 +1,68 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: ONE TYPE FOR PERMIDS ACROSS THE PIPELINE, WITH DENSE INTEGER CODES FOR JOINS AND GROUPBYS
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import numpy as np
+import pandas as pd
+
+### SETTINGS ------------------------
+PERMID_DTYPE = "Int64"  # nullable int64, missing permids are <NA>
+CODE_DTYPE = "int32"
+MISSING_CODE = -1
+
+
+### CONVERSIONS ------------------------
+def to_permids(values):
+    # ints, floats (e.g. from excel), strings and missing values (incl. "" and "<NA>") -> nullable int64
+    values = pd.Series(values)
+    if values.dtype == PERMID_DTYPE:
+        return values
+    if values.dtype == object or pd.api.types.is_string_dtype(values):
+        values = values.replace({"": None, "<NA>": None})
+    return pd.to_numeric(values, errors="coerce").astype(PERMID_DTYPE)
+
+
+def permids_to_str(values):
+    # only at the API boundary: permids as the strings LSEG expects, missing permids stay missing
+    return to_permids(values).astype("string")
+
+
+def permid_strings(values):
+    # e.g. for a get_data universe or a screen query: distinct permids as strings, in their original order
+    return permids_to_str(values).dropna().drop_duplicates().tolist()
+
+
+### INTERNING ------------------------
+class PermIDInterner:
+    # gives every permid a dense integer code (0, 1, 2, ...) in the order first seen, missing permids get -1
+    # codes are small, fixed width and contiguous, so joins and groupbys on them are cheap
+    def __init__(self):
+        self.index = pd.Index([], dtype="int64")
+
+    def __len__(self):
+        return len(self.index)
+
+    def codes(self, values):
+        permids = to_permids(values).to_numpy(dtype="int64", na_value=MISSING_CODE)
+        new = pd.unique(permids[(permids != MISSING_CODE)])
+        new = new[self.index.get_indexer(new) == -1]
+        if len(new) > 0:
+            self.index = self.index.append(pd.Index(new))
+        codes = self.index.get_indexer(permids)  # missing permids aren't in the index, so get -1
+        return codes.astype(CODE_DTYPE)
+
+    def permids(self, codes):
+        # codes back to permids
+        codes = np.asarray(codes)
+        if len(self.index) == 0:
+            return pd.Series(pd.NA, index=range(len(codes)), dtype=PERMID_DTYPE)
+        permids = pd.Series(self.index.to_numpy()[codes.clip(min=0)], dtype=PERMID_DTYPE)
+        return permids.mask(codes == MISSING_CODE)
+
+    def to_frame(self):
+        return pd.DataFrame(
+            {"permid_code": np.arange(len(self.index), dtype=CODE_DTYPE), "permid": self.index.astype(PERMID_DTYPE)}
+        )
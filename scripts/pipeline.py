@@ -0,0 +1,140 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: RUNNING PIPELINE STAGES ONLY WHEN THEIR INPUTS OR PARAMETERS HAVE CHANGED
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import datetime
+import hashlib
+import json
+import os
+import runpy
+import sys
+import time
+
+### SETTINGS ------------------------
+STATE_PATH = "./intermediate-results/pipeline-state.json"
+HASH_BLOCK_BYTES = 1 << 20
+
+
+### FINGERPRINTS ------------------------
+class FileHasher:
+    # sha256 of file contents, remembered by (size, modified time) so unchanged files aren't read again
+    def __init__(self, known=None):
+        self.known = {} if known is None else known
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        known = self.known.get(key)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2]
+
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_BYTES), b""):
+                sha.update(block)
+        self.known[key] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+        return sha.hexdigest()
+
+    def path_hash(self, path):
+        # a file, every file in a directory (e.g. a partitioned dataset), or None if it doesn't exist
+        if os.path.isfile(path):
+            return self.file_hash(path)
+        if not os.path.isdir(path):
+            return None
+
+        sha = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for f in sorted(files):
+                file_path = os.path.join(root, f)
+                sha.update(os.path.relpath(file_path, path).encode())
+                sha.update(self.file_hash(file_path).encode())
+        return sha.hexdigest()
+
+
+def fingerprint(hasher, paths, params):
+    # one hash of the input files' contents and the parameters, which must be json serialisable
+    return hashlib.sha256(
+        json.dumps(
+            {"inputs": {path: hasher.path_hash(path) for path in paths}, "params": params},
+            sort_keys=True,
+            default=str,
+        ).encode()
+    ).hexdigest()
+
+
+### TASKS ------------------------
+class Task:
+    # a script run as one stage, with the files it reads and writes and any parameters that change its results
+    # paths are relative to the working directory the runner is started from, or absolute
+    def __init__(self, name, script, inputs=(), outputs=(), params=None):
+        self.name = name
+        self.script = script
+        self.inputs = [script] + list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+
+
+class Pipeline:
+    # runs tasks in order, skipping any whose inputs, parameters and outputs are unchanged since its last run
+    # a task's outputs are usually a later task's inputs, so re-running a stage re-runs what depends on it
+    def __init__(self, tasks, state_path=STATE_PATH):
+        self.tasks = tasks
+        self.state_path = state_path
+        self.state = {"tasks": {}, "hashes": {}}
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                self.state = json.load(f)
+        self.hasher = FileHasher(self.state["hashes"])
+
+    def is_up_to_date(self, task, task_fingerprint):
+        last_run = self.state["tasks"].get(task.name)
+        if last_run is None or last_run["fingerprint"] != task_fingerprint:
+            return False
+        # outputs deleted or edited since the last run
+        return all(
+            self.hasher.path_hash(path) is not None and self.hasher.path_hash(path) == last_run["outputs"].get(path)
+            for path in task.outputs
+        )
+
+    def run(self, force=()):
+        # force is a list of task names to run whether or not they're up to date
+        for task in self.tasks:
+            task_fingerprint = fingerprint(self.hasher, task.inputs, task.params)
+            if task.name not in force and self.is_up_to_date(task, task_fingerprint):
+                print(f"Skipping {task.name}: up to date")
+                continue
+
+            print(f"Running {task.name} ({task.script})")
+            start = time.time()
+            self.run_script(task.script)
+
+            self.state["tasks"][task.name] = {
+                "fingerprint": task_fingerprint,
+                "outputs": {path: self.hasher.path_hash(path) for path in task.outputs},
+                "completed_at": datetime.datetime.now().isoformat(),
+                "seconds": round(time.time() - start, 1),
+            }
+            self.save()
+            print(f"Completed {task.name} in {time.time() - start:.1f} seconds")
+
+    def run_script(self, script):
+        # scripts change directory and import helpers from their own folder, so both are restored afterwards
+        cwd = os.getcwd()
+        script_dir = os.path.dirname(os.path.abspath(script))
+        sys.path.insert(0, script_dir)
+        try:
+            runpy.run_path(os.path.abspath(script), run_name="__main__")
+        finally:
+            os.chdir(cwd)
+            sys.path.remove(script_dir)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.state_path)
@@ -0,0 +1,136 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: CACHING REFINITIV RESPONSES ON DISK SO REPEATED QUERIES DON'T HIT THE API
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+
+### SETTINGS ------------------------
+CACHE_DIR = "./intermediate-results/lseg-cache"
+TTL_SECONDS = 7 * 24 * 60 * 60  # responses older than a week are fetched again
+MAX_BYTES = 2 * 1024**3  # least recently used responses are removed above 2GB
+
+
+### RESPONSE CACHE ------------------------
+def cache_key(endpoint, args, kwargs):
+    # same endpoint, universe/query, fields and parameters -> same key
+    # arguments left as None are dropped, so passing parameters=None is the same as leaving it out
+    kwargs = {key: value for key, value in kwargs.items() if value is not None}
+    request = {"endpoint": endpoint, "args": args, "kwargs": kwargs}
+    request_json = json.dumps(request, sort_keys=True, default=str)
+    return hashlib.sha256(request_json.encode()).hexdigest()
+
+
+class ResponseCache:
+    # one pickle file per response, named by the hash of the request
+    # file modification times are updated on each hit and used for least recently used eviction
+    def __init__(self, cache_dir=CACHE_DIR, ttl_seconds=TTL_SECONDS, max_bytes=MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+        self.local = threading.local()  # whether this thread's last call was a hit, for run reports
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(entry.stat().st_size for entry in self.entries())
+
+    def entries(self):
+        return [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".pkl")]
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".pkl")
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def get(self, key):
+        # returns (True, response) on a hit and (False, None) on a miss
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.count("misses")
+            return False, None
+
+        if time.time() - entry["created"] > self.ttl_seconds:
+            self.count("expired")
+            self.count("misses")
+            self.remove(path)
+            return False, None
+
+        os.utime(path)  # mark as recently used
+        self.count("hits")
+        return True, entry["response"]
+
+    def put(self, key, response):
+        path = self.path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"  # one temp file per thread
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"created": time.time(), "response": response}, f)
+        size = os.path.getsize(tmp_path)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.total_bytes += size - old_size
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self.lock:
+            self.total_bytes -= size
+
+    def evict(self):
+        # remove least recently used responses until back under the size cap
+        for entry in sorted(self.entries(), key=lambda entry: entry.stat().st_mtime):
+            if self.total_bytes <= self.max_bytes:
+                break
+            self.remove(entry.path)
+            self.count("evictions")
+
+    def clear(self):
+        for entry in self.entries():
+            self.remove(entry.path)
+
+    def wrap(self, func, endpoint):
+        # e.g. get_data = cache.wrap(rd.get_data, "get_data"), then call get_data as normal
+        # errors are not cached
+        def cached_func(*args, **kwargs):
+            key = cache_key(endpoint, args, kwargs)
+            hit, response = self.get(key)
+            self.local.last_hit = hit
+            if hit:
+                return response
+
+            response = func(*args, **kwargs)
+            self.put(key, response)
+            return response
+
+        return cached_func
+
+    def last_call_was_hit(self):
+        return getattr(self.local, "last_hit", False)
+
+    def print_stats(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        hit_rate = self.stats["hits"] / lookups if lookups else 0
+        print(
+            f"Response cache: {self.stats['hits']} hits, {self.stats['misses']} misses "
+            f"({hit_rate:.0%} hit rate), {self.stats['expired']} expired, "
+            f"{self.stats['evictions']} evicted, {self.total_bytes / 1024**2:.1f}MB on disk"
+        )
@@ -0,0 +1,84 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: COLLECTING QUERY RESULTS WITHOUT RE-COPYING A GROWING DATAFRAME
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import os
+
+import pandas as pd
+
+### SETTINGS ------------------------
+# rows held in memory before a chunk is written to disk (only when spilling to disk)
+CHUNK_ROWS = 100_000
+
+
+### RESULTS SINK ------------------------
+class ResultsSink:
+    # collects result dataframes in a list and concatenates them once at the end
+    # if spill_dir is given, chunks of results are written there as they fill up so memory stays bounded
+    def __init__(self, spill_dir=None, chunk_rows=CHUNK_ROWS):
+        self.spill_dir = spill_dir
+        self.chunk_rows = chunk_rows
+        self.buffer = []
+        self.buffer_rows = 0
+        self.part_files = []
+        self.n_rows = 0
+
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def append(self, df):
+        if df is None or df.empty:
+            return
+
+        self.buffer.append(df)
+        self.buffer_rows += len(df)
+        self.n_rows += len(df)
+
+        if self.spill_dir is not None and self.buffer_rows >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        # write buffered results to the next part file
+        if self.spill_dir is None or not self.buffer:
+            return
+
+        part_file = os.path.join(self.spill_dir, f"part-{len(self.part_files):05d}.csv")
+        pd.concat(self.buffer, ignore_index=True).to_csv(part_file, index=False)
+        self.part_files.append(part_file)
+        self.buffer = []
+        self.buffer_rows = 0
+
+    def to_frame(self):
+        # materialise all results as one dataframe, in the order they were appended
+        if self.spill_dir is not None:
+            self.flush()
+            frames = [pd.read_csv(part_file) for part_file in self.part_files]
+        else:
+            frames = self.buffer
+
+        if not frames:
+            return pd.DataFrame()
+
+        return pd.concat(frames, ignore_index=True)
+
+    def write_csv(self, path):
+        # stream all results to one csv without holding them in memory together
+        self.flush()
+        if self.spill_dir is None:
+            self.to_frame().to_csv(path, index=False)
+            return
+
+        # parts can have different columns (e.g. empty search results), so align on all columns seen
+        columns = []
+        for part_file in self.part_files:
+            for col in pd.read_csv(part_file, nrows=0).columns:
+                if col not in columns:
+                    columns.append(col)
+
+        for i, part_file in enumerate(self.part_files):
+            pd.read_csv(part_file).reindex(columns=columns).to_csv(
+                path, mode="w" if i == 0 else "a", header=i == 0, index=False
+            )
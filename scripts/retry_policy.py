@@ -0,0 +1,140 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: RETRYING FAILED REFINITIV REQUESTS WITHOUT MAKING SERVER THROTTLING WORSE
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import random
+import threading
+import time
+
+### SETTINGS ------------------------
+MAX_RETRIES = 5
+BASE_DELAY = 0.5  # seconds before the first retry, doubling each retry
+THROTTLE_BASE_DELAY = 5  # throttled requests back off from a longer delay
+MAX_DELAY = 60
+FAILURE_THRESHOLD = 10  # consecutive failures across all work items before pausing
+COOLDOWN = 120  # seconds to pause everything once the backend looks unhealthy
+
+### CLASSIFYING ERRORS ------------------------
+THROTTLE = "throttle"
+TIMEOUT = "timeout"
+BAD_QUERY = "bad query"
+OTHER = "other"
+
+throttle_keywords = ["429", "too many requests", "throttl", "rate limit"]
+timeout_keywords = ["timeout", "timed out", "read operation", "connection"]
+bad_query_keywords = [
+    "400",
+    "bad request",
+    "invalid",
+    "syntax",
+    "unable to resolve",
+    "unable to collect data",
+    "not found",
+]
+
+
+def classify_error(e):
+    # errors from refinitiv.data are mostly RDError with the reason in the message
+    if isinstance(e, TimeoutError):
+        return TIMEOUT
+
+    message = f"{getattr(e, 'code', '')} {e}".lower()
+    if any(keyword in message for keyword in throttle_keywords):
+        return THROTTLE
+    if any(keyword in message for keyword in timeout_keywords):
+        return TIMEOUT
+    if any(keyword in message for keyword in bad_query_keywords):
+        return BAD_QUERY
+    return OTHER
+
+
+### CIRCUIT BREAKER ------------------------
+class CircuitBreaker:
+    # shared by all work items: after too many consecutive failures every request waits out a cooldown
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, cooldown=COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.open_until = 0
+        self.lock = threading.Lock()
+
+    def wait_until_closed(self):
+        wait = self.open_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if (
+                self.consecutive_failures >= self.failure_threshold
+                and time.monotonic() >= self.open_until
+            ):
+                self.open_until = time.monotonic() + self.cooldown
+                print(
+                    f"{self.consecutive_failures} consecutive failures, "
+                    f"pausing all requests for {self.cooldown}s"
+                )
+
+
+### RETRY POLICY ------------------------
+class RetryPolicy:
+    def __init__(
+        self,
+        max_retries=MAX_RETRIES,
+        base_delay=BASE_DELAY,
+        throttle_base_delay=THROTTLE_BASE_DELAY,
+        max_delay=MAX_DELAY,
+        circuit_breaker=None,
+        report=None,
+    ):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.throttle_base_delay = throttle_base_delay
+        self.max_delay = max_delay
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.report = report  # RunReport to count retries in, if any
+
+    def delay(self, retry_count, error_type):
+        # exponential backoff with jitter, so retries from parallel work items don't arrive together
+        base_delay = self.throttle_base_delay if error_type == THROTTLE else self.base_delay
+        delay = min(self.max_delay, base_delay * 2 ** (retry_count - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def run(self, func, *args, description="", group="", **kwargs):
+        # call func(*args, **kwargs), retrying on errors worth retrying
+        # the retry count belongs to this call only, and the last error is raised once retries run out
+        retry_count = 0
+        while True:
+            self.circuit_breaker.wait_until_closed()
+            try:
+                result = func(*args, **kwargs)
+                self.circuit_breaker.record_success()
+                return result
+
+            except Exception as e:
+                error_type = classify_error(e)
+                print(f"An error occurred with {description} ({error_type}): {e}")
+
+                # a bad query fails the same way every time, so don't retry it or count it against the backend
+                if error_type == BAD_QUERY:
+                    raise
+
+                self.circuit_breaker.record_failure()
+                retry_count += 1
+                if retry_count > self.max_retries:
+                    raise
+
+                if self.report is not None:
+                    self.report.count_retry(group)
+
+                delay = self.delay(retry_count, error_type)
+                print(f"Retrying {description} in {delay:.1f}s ({retry_count}/{self.max_retries})...")
+                time.sleep(delay)
@@ -0,0 +1,147 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: RUNNING SCRIPTS 1-5 IN ORDER, SKIPPING STAGES WHOSE INPUTS HAVEN'T CHANGED
+# github.com/lyd-m/wwf-tipping-points
+
+### PREREQUSITES -------------------------
+# same as the scripts being run, e.g. the desktop Refinitiv App open for stages that query LSEG
+# each stage is a whole script, fingerprinted by the script, the helper modules it imports, its input files
+# and parameters such as the LSEG fields it pulls. pipeline state is kept in ./intermediate-results/pipeline-state.json
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import os
+
+import pandas as pd
+
+from pipeline import Pipeline, Task
+
+### SET DATA FILES WORKING DIRECTORY -----------------
+path = "/Users/ucliipp/Library/CloudStorage/OneDrive-UniversityCollegeLondon/Documents/programming/main-projects/wwf-tipping-points"
+os.chdir(path)
+
+company_research_path = "/Users/ucliipp/Library/CloudStorage/OneDrive-SharedLibraries-UniversityCollegeLondon/CEP-IIPP P4NE grant 2019-2021 - Documents/General/WWF tipping points/Main research/Empirical paper/Company research"
+companies_path = "/Users/ucliipp/Library/CloudStorage/OneDrive-SharedLibraries-UniversityCollegeLondon/CEP-IIPP P4NE grant 2019-2021 - Documents/General/WWF tipping points/Main research/2025 Empirical paper/Company research/companies.xlsx"
+
+### SETTINGS ------------------------
+# stages to run even if up to date, e.g. ["info by permid"] to refresh stale permids
+force = []
+
+### STAGE PARAMETERS ------------------------
+# only the fields a stage pulls are part of its fingerprint, so e.g. adding a fundamentals field
+# doesn't re-run the deal pulls
+flds = pd.read_excel("./input-data/lseg_columns_needed.xlsx")
+
+
+def fields_for(asset_classes):
+    return {
+        asset: flds.loc[flds["Asset class"].str.contains(asset, na=False), "LSEG field name"].tolist()
+        for asset in asset_classes
+    }
+
+
+# helper modules used by the stages that query LSEG
+lseg_helpers = [
+    "./scripts/data_source.py",
+    "./scripts/lseg_session.py",
+    "./scripts/response_cache.py",
+    "./scripts/retry_policy.py",
+    "./scripts/run_report.py",
+    "./scripts/fetch_engine.py",
+    "./scripts/lseg_deals.py",
+    "./scripts/results_sink.py",
+    "./scripts/columnar_store.py",
+    "./scripts/permids.py",
+]
+name_helpers = [
+    "./scripts/name_normalisation.py",
+    "./scripts/name_matching.py",
+    "./scripts/entity_resolution.py",
+]
+
+deals_datasets = [
+    "./intermediate-results/datasets/loan-deals",
+    "./intermediate-results/datasets/bond-deals",
+    "./intermediate-results/datasets/equity-deals",
+]
+ultimate_parents_db = "./intermediate-results/ultimate_parents_database.sqlite"
+ultimate_parents_excel = "./intermediate-results/ultimate_parents_database.xlsx"
+
+### STAGES ------------------------
+tasks = [
+    Task(
+        "logging companies",
+        "./scripts/1-comp-data-canada-logging-rdp-search.py",
+        inputs=name_helpers
+        + [
+            "./scripts/name_clustering.py",
+            "./scripts/overlap_aggregation.py",
+            f"{company_research_path}/Boreal-Canada/Output-data/canada-logging-companies-to-search.xlsx",
+            f"{company_research_path}/Boreal-Canada/Output-data/canada-logging-companies-consolidated.xlsx",
+            f"{company_research_path}/Boreal-Canada/Output-data/canada_logging_overlap_split.csv",
+        ],
+        outputs=[
+            f"{company_research_path}/Boreal-Canada/Output-data/canada-logging-companies-consolidated-proposed.xlsx",
+            f"{company_research_path}/Boreal-Canada/Output-data/canada-logging-overlap-grouped.xlsx",
+        ],
+    ),
+    Task(
+        "deals pull",
+        "./scripts/2-pull-financial-data.py",
+        inputs=lseg_helpers + ["./scripts/job_journal.py", "./scripts/company_hierarchy.py", companies_path],
+        outputs=deals_datasets,
+        params={"fields": fields_for(["Bond deals", "Equity deals", "Loans"])},
+    ),
+    # the ultimate parents database is read and updated by this stage, so it's only an output here
+# the excel version is an input, so manually checked matches added to it are imported
+    Task(
+        "ultimate parents mapping",
+        "./scripts/3-ultimate-parents-mapping.py",
+        inputs=lseg_helpers
+        + name_helpers
+        + [
+            "./scripts/deal_files.py",
+            "./scripts/ultimate_parents.py",
+            "./scripts/ultimate_parents_store.py",
+            "./scripts/flow_attribution.py",
+            ultimate_parents_excel,
+        ]
+        + deals_datasets,
+        outputs=[ultimate_parents_db],
+        params={"fields": fields_for(["Bond deals", "Equity deals", "Loans"])},
+    ),
+    Task(
+        "info by permid",
+        "./scripts/4-pull-info-by-permid.py",
+        inputs=lseg_helpers
+        + [
+            "./scripts/info_refresh.py",
+            "./scripts/ultimate_parents_store.py",
+            "./scripts/company_hierarchy.py",
+            ultimate_parents_db,
+            companies_path,
+        ],
+        outputs=[
+            "./intermediate-results/datasets/financial-institutions-info-by-permid",
+            "./intermediate-results/datasets/companies-info-by-permid",
+        ],
+        params={"fields": fields_for(["Fundamentals - Finance", "Fundamentals - Companies"])},
+    ),
+    Task(
+        "flow attribution",
+        "./scripts/5-attribute-financial-flows.py",
+        inputs=[
+            "./scripts/flow_attribution.py",
+            "./scripts/columnar_store.py",
+            "./scripts/permids.py",
+            "./scripts/ultimate_parents_store.py",
+            ultimate_parents_db,
+        ]
+        + deals_datasets,
+        outputs=["./intermediate-results/datasets/financial-flows-by-financier"],
+        params={"fields": fields_for(["Bond deals", "Equity deals", "Loans"])},
+    ),
+]
+
+### RUN PIPELINE ------------------------
+Pipeline(tasks).run(force=force)
@@ -0,0 +1,115 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: TIMING EVERY REFINITIV REQUEST AND WRITING A REPORT AT THE END OF EACH RUN
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import datetime
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+
+### SETTINGS ------------------------
+REPORTS_DIR = "./intermediate-results/run-reports"
+PERCENTILES = [0.5, 0.95, 0.99]
+
+
+### RUN REPORT ------------------------
+class RunReport:
+    # one record per call to LSEG, written out as requests csv and summary json at the end of the run
+    def __init__(self, run_name, reports_dir=REPORTS_DIR):
+        self.run_name = run_name
+        self.reports_dir = reports_dir
+        self.started = time.time()
+        self.requests = []
+        self.retries = {}
+        self.lock = threading.Lock()
+
+    def instrument(self, func, endpoint, group="", cache=None, rate_limiter=None):
+        # e.g. get_data = report.instrument(get_data, "get_data", group="Bond deals", cache=response_cache,
+        #                                   rate_limiter=token_bucket)
+        # group is what latencies are summarised by, e.g. asset class
+        # time spent waiting for rate_limiter (a TokenBucket inside func) is recorded as limiter_wait and
+        # left out of latency, so latency is LSEG's response time whatever the concurrency settings
+        def instrumented_func(*args, **kwargs):
+            record = {"endpoint": endpoint, "group": group, "started": time.time()}
+            if rate_limiter is not None:
+                rate_limiter.reset_wait()
+            start = time.perf_counter()
+            try:
+                response = func(*args, **kwargs)
+                record["rows"], record["columns"] = getattr(response, "shape", (None, None))
+                record["error"] = ""
+                return response
+            except Exception as e:
+                record["rows"], record["columns"] = 0, 0
+                record["error"] = f"{type(e).__name__}: {e}"
+                raise
+            finally:
+                record["limiter_wait"] = rate_limiter.last_wait() if rate_limiter is not None else 0.0
+                record["latency"] = time.perf_counter() - start - record["limiter_wait"]
+                record["cache_hit"] = cache.last_call_was_hit() if cache else False
+                with self.lock:
+                    self.requests.append(record)
+
+        return instrumented_func
+
+    def count_retry(self, group=""):
+        with self.lock:
+            self.retries[group] = self.retries.get(group, 0) + 1
+
+    def summary(self):
+        requests = pd.DataFrame(
+            self.requests,
+            columns=["endpoint", "group", "started", "rows", "columns", "error", "latency", "limiter_wait", "cache_hit"],
+        )
+        summary = []
+        for (endpoint, group), group_requests in requests.groupby(["endpoint", "group"], sort=True):
+            # latency percentiles are over requests that went to LSEG, cache hits are counted separately
+            api_requests = group_requests[~group_requests["cache_hit"].astype(bool)]
+            group_summary = {
+                "endpoint": endpoint,
+                "group": group,
+                "requests": len(group_requests),
+                "cache_hits": int(group_requests["cache_hit"].astype(bool).sum()),
+                "errors": int((group_requests["error"] != "").sum()),
+                "retries": self.retries.get(group, 0),
+                "rows": int(group_requests["rows"].fillna(0).sum()),
+                "total_latency": round(float(api_requests["latency"].sum()), 3),
+                "total_limiter_wait": round(float(group_requests["limiter_wait"].sum()), 3),
+            }
+            for percentile in PERCENTILES:
+                latency = api_requests["latency"].quantile(percentile) if len(api_requests) else None
+                group_summary[f"latency_p{int(percentile * 100)}"] = (
+                    round(float(latency), 3) if latency is not None else None
+                )
+            summary.append(group_summary)
+
+        return requests, summary
+
+    def write(self):
+        # writes <date>-<run name>-requests.csv and <date>-<run name>-summary.json
+        os.makedirs(self.reports_dir, exist_ok=True)
+        requests, summary = self.summary()
+        file_prefix = os.path.join(
+            self.reports_dir, f"{datetime.date.today()}-{self.run_name}"
+        )
+
+        requests.to_csv(f"{file_prefix}-requests.csv", index=False)
+        with open(f"{file_prefix}-summary.json", "w") as f:
+            json.dump(
+                {
+                    "run_name": self.run_name,
+                    "wall_clock_seconds": round(time.time() - self.started, 3),
+                    "summary": summary,
+                },
+                f,
+                indent=2,
+            )
+
+        print(pd.DataFrame(summary).to_string(index=False))
+        print(f"Run report saved to {file_prefix}-summary.json")
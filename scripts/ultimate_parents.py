@@ -0,0 +1,43 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: SEARCHING REFINITIV FOR THE ULTIMATE PARENTS OF DEAL MANAGERS
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import pandas as pd
+
+### SEARCH SETTINGS ------------------------
+ups_select = "CommonName, OAPermID, ParentOrganisationName, ParentCompanyOAPermID, UltimateParentOrganisationName, UltimateParentCompanyOAPermID"
+
+# columns of every search result, including queries with no match
+ups_result_columns = ["search_query", "source"] + [col.strip() for col in ups_select.split(",")]
+
+
+### SEARCHING ------------------------
+def search_ultimate_parent(search, search_query, source, retry_policy):
+    # search is a data source's search (organisations view), returns the best match tagged with the query and source
+    # returns None if the retry limit is reached
+    try:
+        # retries back off exponentially, and the retry count is reset for each query
+        search_result = retry_policy.run(
+            search,
+            query=search_query,
+            top=1,  # choose best match
+            select=ups_select,
+            description=search_query,
+            group=source,
+        )
+    except Exception:
+        print(f"Retry limit reached, no result found for {search_query}.")
+        return None
+
+    # if no match found, create an empty row for that query with reference data (query, asset class)
+    if search_result.empty:
+        search_result = pd.DataFrame({"search_query": [search_query], "source": [source]})
+    # otherwise store result and add reference data (query, asset class)
+    else:
+        search_result["search_query"] = search_query
+        search_result["source"] = source
+
+    return search_result
@@ -0,0 +1,168 @@
+## PROJECT: FINANCIAL FLOWS TO ECOSYSTEM TIPPING POINTS ##
+# AIM: STORING THE ULTIMATE PARENTS DATABASE IN AN INDEXED SQLITE FILE
+# github.com/lyd-m/wwf-tipping-points
+
+### DEPENDENCIES --------------------------
+# python=3.11
+
+import datetime
+import os
+import sqlite3
+
+import pandas as pd
+
+from permids import to_permids
+
+### SETTINGS ------------------------
+DB_PATH = "./intermediate-results/ultimate_parents_database.sqlite"
+EXCEL_PATH = "./intermediate-results/ultimate_parents_database.xlsx"
+
+ups_columns = [
+    "search_query",
+    "CommonName",
+    "OAPermID",
+    "UltimateParentOrganisationName",
+    "UltimateParentCompanyOAPermID",
+]
+ups_permid_columns = ["OAPermID", "UltimateParentCompanyOAPermID"]
+
+# sqlite limits the number of parameters in one statement
+SQL_CHUNK_SIZE = 900
+
+
+### ULTIMATE PARENTS STORE ------------------------
+def to_sql_value(col, value):
+    # sqlite needs None for missing values and python ints for permids
+    if pd.isna(value):
+        return None
+    return int(value) if col in ups_permid_columns else value
+
+
+class UltimateParentsStore:
+    # one row per search query, indexed by search query (primary key) and by both permids
+    # read_only = True for stages that only look matches up, so they never create an empty database file
+    def __init__(self, db_path=DB_PATH, read_only=False):
+        self.db_path = db_path
+        if read_only:
+            if not os.path.exists(db_path):
+                raise FileNotFoundError(
+                    f"No ultimate parents database at {db_path}, run 3-ultimate-parents-mapping.py first"
+                )
+            self.conn = sqlite3.connect(f"file:{os.path.abspath(db_path)}?mode=ro", uri=True)
+            if self.excel_is_newer():
+                print(
+                    f"WARNING: {EXCEL_PATH} has changed since {db_path} was last updated, "
+                    "run 3-ultimate-parents-mapping.py to import it"
+                )
+            return
+
+        self.conn = sqlite3.connect(db_path)
+        with self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS ultimate_parents (
+                    search_query TEXT PRIMARY KEY,
+                    CommonName TEXT,
+                    OAPermID INTEGER,
+                    UltimateParentOrganisationName TEXT,
+                    UltimateParentCompanyOAPermID INTEGER,
+                    updated_at TEXT
+                )
+                """
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_oa_permid ON ultimate_parents (OAPermID)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_up_permid ON ultimate_parents (UltimateParentCompanyOAPermID)"
+            )
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM ultimate_parents").fetchone()[0]
+
+    def is_empty(self):
+        # e.g. a new file, or one created before the excel version was imported
+        return len(self) == 0
+
+    def last_updated(self):
+        updated_at = self.conn.execute("SELECT MAX(updated_at) FROM ultimate_parents").fetchone()[0]
+        return datetime.datetime.fromisoformat(updated_at) if updated_at else None
+
+    def excel_is_newer(self, path=EXCEL_PATH):
+        # True if the excel version (e.g. with manually checked rows added) was saved after the last update
+        if not os.path.exists(path):
+            return False
+        last_updated = self.last_updated()
+        return last_updated is None or datetime.datetime.fromtimestamp(os.path.getmtime(path)) > last_updated
+
+    ### LOOKUPS ------------------------
+    def known_queries(self, search_queries):
+        # the subset of search_queries already in the database, looked up through the primary key index
+        search_queries = [q for q in pd.unique(pd.Series(search_queries, dtype=object)) if isinstance(q, str)]
+        known = set()
+        for i in range(0, len(search_queries), SQL_CHUNK_SIZE):
+            chunk = search_queries[i : i + SQL_CHUNK_SIZE]
+            rows = self.conn.execute(
+                f"SELECT search_query FROM ultimate_parents WHERE search_query IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            known.update(row[0] for row in rows)
+        return known
+
+    def new_queries(self, search_queries):
+        # search queries not in the database yet, in their original order
+        known = self.known_queries(search_queries)
+        return [q for q in pd.unique(pd.Series(search_queries, dtype=object)) if isinstance(q, str) and q not in known]
+
+    def get_by_query(self, search_query):
+        return self.read_sql("SELECT * FROM ultimate_parents WHERE search_query = ?", [search_query])
+
+    def get_by_permid(self, permid):
+        # rows where the permid is either the matched organisation or its ultimate parent
+        return self.read_sql(
+            "SELECT * FROM ultimate_parents WHERE OAPermID = ? OR UltimateParentCompanyOAPermID = ?",
+            [int(permid), int(permid)],
+        )
+
+    def read_sql(self, sql, params=()):
+        df = pd.read_sql_query(sql, self.conn, params=params)
+        for col in ups_permid_columns:
+            df[col] = to_permids(df[col])
+        return df.drop(columns="updated_at")
+
+    def to_frame(self):
+        return self.read_sql("SELECT * FROM ultimate_parents ORDER BY rowid")
+
+    ### UPDATES ------------------------
+    def upsert(self, df):
+        # insert new search queries and update existing ones, all in one transaction
+        df = df.reindex(columns=ups_columns).dropna(subset=["search_query"])
+        df = df.drop_duplicates(subset=["search_query"], keep="last")
+        for col in ups_permid_columns:
+            df[col] = to_permids(df[col]).values
+
+        updated_at = datetime.datetime.now().isoformat()
+        rows = [
+            tuple(to_sql_value(col, value) for col, value in zip(ups_columns, row)) + (updated_at,)
+            for row in df.itertuples(index=False)
+        ]
+        with self.conn:
+            self.conn.executemany(
+                f"""
+                INSERT INTO ultimate_parents ({', '.join(ups_columns)}, updated_at)
+                VALUES ({', '.join('?' * (len(ups_columns) + 1))})
+                ON CONFLICT(search_query) DO UPDATE SET
+                {', '.join(f'{col} = excluded.{col}' for col in ups_columns[1:])},
+                updated_at = excluded.updated_at
+                """,
+                rows,
+            )
+        print(f"Upserted {len(rows)} rows into {self.db_path} ({len(self)} rows in total)")
+
+    def import_excel(self, path=EXCEL_PATH):
+        # e.g. to migrate the old excel database, or to add manually checked matches
+        self.upsert(pd.read_excel(path))
+
+    def export_excel(self, path=EXCEL_PATH):
+        self.to_frame().to_excel(path, index=False)
+        print(f"Exported ultimate parents database to {path}")